@@ -47,6 +47,6 @@ def andsager_1999(D):
 
             
            
-AR_MODELS['Thurai_2007'] = Lambda(lambda D: thurai_2007(D),'Aspect-ratio model for rain (Thurai, 2007)')
-AR_MODELS['Andsager_1999'] = Lambda(lambda D: andsager_1999(D),'Aspect-ratio model for rain (Andsager, 1999)')
-AR_MODELS['Brandes_2002'] = Lambda(lambda D: brandes_2002(D),'Aspect-ratio model for rain (Branded, 2002)')
+AR_MODELS['Thurai_2007'] = Lambda(thurai_2007,'Aspect-ratio model for rain (Thurai, 2007)')
+AR_MODELS['Andsager_1999'] = Lambda(andsager_1999,'Aspect-ratio model for rain (Andsager, 1999)')
+AR_MODELS['Brandes_2002'] = Lambda(brandes_2002,'Aspect-ratio model for rain (Branded, 2002)')
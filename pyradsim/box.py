@@ -8,38 +8,129 @@ Created on Mon May 30 13:44:43 2016
 import json
 import numpy as np
 
-from pyradsim.hydrometeor import Hydrometeor
+from pyradsim.hydrometeor import Hydrometeor, get_pol_var_frequency
 from pyradsim.tmatrix import compute_pol_var
+from pyradsim.permittivity_models import get_table_settings
+import pyradsim.constants as constants
+
+def get_integration(config):
+    # Integration settings, either a method name or a dictionary
+    integration = config.get('integration','trapz')
+    if not isinstance(integration,dict):
+        integration = {'method':integration}
+    return integration
+    
+def get_rayleigh_threshold(config):
+    # Threshold on |m| * size parameter below which the Rayleigh approximation
+    # is used, 0 to always use the T-matrix method
+    return config.get('rayleigh_threshold',constants.RAYLEIGH_THRESHOLD)
+    
+def get_permittivity_table(config):
+    # Tabulation of the permittivity models of all hydrometeors, None if the
+    # models are evaluated directly
+    return get_table_settings(config.get('permittivity_table'))
+
+# First stage to recompute when a parameter of the box file changes, all the
+# following stages of STAGES are recomputed too, None if no stage depends on
+# the parameter. Unknown parameters recompute everything
+STAGES = ['permittivity','scattering','integration','pol_vars']
+DEPENDENCIES = {'permittivity':'permittivity','T':'permittivity','frequency':'permittivity',
+                'aspect_ratio':'scattering','canting_angle_std':'scattering',
+                'orientation_averaging':'scattering','orientation_quadrature':'scattering',
+                'elevation_angle':'scattering','psd':'integration','psd_range':'integration',
+                'P':None,'azimuth':None,'position':None,'size':None,'weight':None}
+
+def get_dirty_stages(key):
+    # Stages to recompute when the parameter at the key path of a box (e.g.
+    # ['hydrometeors','rain','psd']) changes
+    stage = DEPENDENCIES.get(key[-1],STAGES[0])
+    if stage is None:
+        return []
+    return STAGES[STAGES.index(stage):]
+    
+def is_hydrometeor_dirty(name, dirty):
+    # True if one of the modified key paths of a box concerns the hydrometeor
+    for key in dirty:
+        if key[0] == 'hydrometeors' and len(key) > 1 and key[1] != name:
+            continue
+        if 'integration' in get_dirty_stages(key):
+            return True
+    return False
+    
+def get_frequency(radar, config):
+    # Radar frequency of a box, or list of frequencies, the 'frequencies'
+    # entry of the configuration file overrides the frequency of all boxes
+    if config.get('frequencies') is not None:
+        return config['frequencies']
+    return radar['frequency']
+    
+# Dimensions of the polarimetric variables with several frequencies and/or
+# elevation angles, in this order
+POL_VAR_DIMENSIONS = ['frequency','elevation_angle']
+
+def add_dimensions(pol, frequency, elevation_angle):
+    # Assigns the frequencies and elevation angles of the dimensions of the
+    # polarimetric variables (in this order) as attributes
+    if np.ndim(frequency) > 0:
+        pol.attributes['frequency'] = np.array(frequency)
+    if np.ndim(elevation_angle) > 0:
+        pol.attributes['elevation_angle'] = np.array(elevation_angle)
+    return pol
 
 class Box(object):
-    def __init__(self,name,box,config):
+    def __init__(self,name,box,config,cache = None,luts = None,executor = None):
         self.name = name
-        self.radar = box['radar']
-        self.atmosphere = box['atmosphere']
-        self.geometry = box['geometry']
+        # Shallow copies, box can be a view on the boxes (ConfigOverlay)
+        self.radar = dict(box['radar'])
+        self.atmosphere = dict(box['atmosphere'])
+        self.geometry = dict(box['geometry'])
         self.weight = box['weight']
         self.hydrometeors = []
         self.config = config
+        self.frequency = get_frequency(self.radar,self.config)
+        self._ensemble_SZ = None # Last outputs, reused until the box changes
+        self._pol_vars = None
         
         for k in box['hydrometeors']:
             self.hydrometeors.append(Hydrometeor(k,box['hydrometeors'][k],
-                 self.radar['frequency'],self.atmosphere['T'],
-                 self.geometry['elevation_angle'],self.config['nbins_d']))   
+                 self.frequency,self.atmosphere['T'],
+                 self.geometry['elevation_angle'],self.config['nbins_d'],
+                 cache = cache, luts = luts, executor = executor,
+                 integration = get_integration(self.config),
+                 rayleigh_threshold = get_rayleigh_threshold(self.config),
+                 permittivity_table = get_permittivity_table(self.config)))
     
-    def update(self,box,config):
-        self.radar = box['radar']
-        self.atmosphere = box['atmosphere']
-        self.geometry = box['geometry']
+    def update(self,box,config,dirty = None):
+        # dirty is the list of the modified key paths of the box (without the
+        # box name), None if anything may have changed. Hydrometeors that are
+        # not concerned keep their scattering and integration
+        # Shallow copies, box can be a view on the boxes (ConfigOverlay)
+        self.radar = dict(box['radar'])
+        self.atmosphere = dict(box['atmosphere'])
+        self.geometry = dict(box['geometry'])
         self.weight = box['weight']
         self.config = config
+        self.frequency = get_frequency(self.radar,self.config)
         for h in self.hydrometeors:
+            if dirty is not None and not is_hydrometeor_dirty(h.name,dirty):
+                continue
+            self._ensemble_SZ = None
+            self._pol_vars = None
             h.update(box['hydrometeors'][h.name],
-                 self.radar['frequency'],self.atmosphere['T'],
-                 self.geometry['elevation_angle'],self.config['nbins_d'])   
+                 self.frequency,self.atmosphere['T'],
+                 self.geometry['elevation_angle'],self.config['nbins_d'],
+                 get_integration(self.config),get_rayleigh_threshold(self.config),
+                 get_permittivity_table(self.config))
   
     def get_ensemble_SZ(self):
-        ensemble_S = np.zeros((4,),dtype=complex) # Amplitutde matrix
-        ensemble_Z = np.zeros((16,)) # Phase matrix
+        # With several frequencies and/or elevation angles, S and Z have a 
+        # frequency and/or an elevation dimension
+        if self._ensemble_SZ is not None and not self.is_outdated():
+            return self._ensemble_SZ
+        self._pol_vars = None
+        shape = np.shape(self.frequency) + np.shape(self.geometry['elevation_angle'])
+        ensemble_S = np.zeros(shape + (4,),dtype=complex) # Amplitutde matrix
+        ensemble_Z = np.zeros(shape + (16,)) # Phase matrix
         
         for h in self.hydrometeors:      
             print('Simulating scattering of hydrometeor '+h.name)
@@ -48,12 +139,42 @@ class Box(object):
 
             ensemble_S += integ_S
             ensemble_Z += integ_Z
+        self._ensemble_SZ = (ensemble_S, ensemble_Z)
+        return ensemble_S, ensemble_Z
+        
+    def get_ensemble_SZ_batch(self, n, psds):
+        # Ensemble matrices for n sets of PSDs, psds is a dictionary of the 
+        # lists of n PSDs of the hydrometeors that change, the other ones
+        # keep their PSD. S and Z have a leading dimension of size n
+        shape = (n,) + np.shape(self.frequency) + np.shape(self.geometry['elevation_angle'])
+        ensemble_S = np.zeros(shape + (4,),dtype=complex)
+        ensemble_Z = np.zeros(shape + (16,))
+        
+        for h in self.hydrometeors:
+            if h.name in psds:
+                print('Simulating scattering of hydrometeor '+h.name+' for '+
+                      str(n)+' PSDs')
+                integ_S, integ_Z = h.get_SZ_integrated_batch(psds[h.name])
+            else:
+                integ_S, integ_Z = h.get_SZ_integrated()
+            ensemble_S += integ_S
+            ensemble_Z += integ_Z
         return ensemble_S, ensemble_Z
         
+    def is_outdated(self):
+        # True if a hydrometeor was modified since the last outputs, e.g. its
+        # PSD was replaced without update
+        return any([h.is_integ_outdated() for h in self.hydrometeors])
+        
     def get_pol_vars(self):
+        if self._pol_vars is not None and not self.is_outdated():
+            return self._pol_vars
         ensemble_S, ensemble_Z = self.get_ensemble_SZ()
-        pol = compute_pol_var(ensemble_S,ensemble_Z,self.radar['frequency'])       
-        return pol
+        elevation_angle = self.geometry['elevation_angle']
+        pol = compute_pol_var(ensemble_S,ensemble_Z,get_pol_var_frequency(self.frequency,
+                                                                          elevation_angle))
+        self._pol_vars = add_dimensions(pol, self.frequency, elevation_angle)
+        return self._pol_vars
             
     def __str__(self):
         msg = '\n%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%\n'
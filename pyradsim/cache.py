@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 14 10:12:03 2016
+
+@author: wolfensb
+"""
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import warnings
+import contextlib
+import numpy as np
+
+try:
+    import fcntl
+except ImportError: # Windows, no file locking available
+    fcntl = None
+
+INDEX_FILE = 'index.json'
+LOCK_FILE = '.lock'
+
+def create_cache(config):
+    # Returns a ScatteringCache if the configuration file contains a 'cache'
+    # section, None otherwise
+    if config is None or not config.get('cache'):
+        return None
+    cache_config = config['cache']
+    if not isinstance(cache_config, dict):
+        cache_config = {'directory': cache_config}
+    return ScatteringCache(**cache_config)
+
+class ScatteringCache(object):
+    def __init__(self, directory = '~/.pyradsim_cache', max_size = 1000,
+                 max_entries = None):
+        """ Content-addressed on-disk cache of scattering matrices
+                - directory : folder where the matrices are stored
+                - max_size : maximal size of the cache in MB
+                - max_entries : maximal number of entries in the cache
+            Least recently used entries are evicted when one of the limits
+            is exceeded. The cache can be shared by several processes
+        """
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.max_size = max_size
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError: # Created in the meantime by another process
+                pass
+
+        if fcntl is None:
+            warnings.warn('File locking is not available on this platform, '+
+                          'the scattering cache should not be shared between processes')
+
+    @staticmethod
+    def get_key(signature):
+        string = json.dumps(signature, default = str)
+        return hashlib.sha1(string.encode('utf-8')).hexdigest()
+
+    def get(self, signature):
+        # Returns a dictionary of arrays or None if signature is not in cache
+        key = self.get_key(signature)
+        with self._lock():
+            index = self._read_index()
+            filename = self._get_filename(key)
+            if key in index and os.path.exists(filename):
+                with np.load(filename) as data:
+                    arrays = dict((k, data[k]) for k in data.files)
+                index[key]['last_access'] = time.time()
+                self._write_index(index)
+                self.hits += 1
+                return arrays
+            elif key in index: # File was removed by hand
+                index.pop(key)
+                self._write_index(index)
+        self.misses += 1
+        return None
+
+    def put(self, signature, **arrays):
+        key = self.get_key(signature)
+        # Write arrays to a temporary file first, so that other processes
+        # never read a partially written file
+        fd, tmp_filename = tempfile.mkstemp(suffix = '.npz', dir = self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        with self._lock():
+            os.replace(tmp_filename, self._get_filename(key))
+            index = self._read_index()
+            index[key] = {'size': os.path.getsize(self._get_filename(key)),
+                          'last_access': time.time()}
+            self._evict(index)
+            self._write_index(index)
+
+    def clear(self):
+        with self._lock():
+            index = self._read_index()
+            for key in index.keys():
+                self._remove(key)
+            self._write_index({})
+
+    def get_stats(self):
+        with self._lock():
+            index = self._read_index()
+        n_requests = self.hits + self.misses
+        stats = {}
+        stats['hits'] = self.hits
+        stats['misses'] = self.misses
+        stats['hit_rate'] = self.hits / float(n_requests) if n_requests else 0.
+        stats['evictions'] = self.evictions
+        stats['entries'] = len(index)
+        stats['size'] = sum([v['size'] for v in index.values()]) / 1024.**2 # in MB
+        return stats
+
+    def __str__(self):
+        stats = self.get_stats()
+        msg = 'Scattering cache ('+self.directory+'): '
+        msg += str(stats['hits'])+' hits, '+str(stats['misses'])+' misses, '
+        msg += str(stats['entries'])+' entries ({:.1f} MB)'.format(stats['size'])
+        return msg
+
+    def _evict(self, index):
+        # Remove least recently used entries until the limits are respected
+        max_size = None
+        if self.max_size is not None:
+            max_size = self.max_size * 1024.**2
+        keys = sorted(index.keys(), key = lambda k: index[k]['last_access'])
+        total_size = sum([index[k]['size'] for k in keys])
+        while len(keys) > 1:
+            too_big = max_size is not None and total_size > max_size
+            too_many = self.max_entries is not None and len(keys) > self.max_entries
+            if not (too_big or too_many):
+                break
+            key = keys.pop(0)
+            total_size -= index[key]['size']
+            index.pop(key)
+            self._remove(key)
+            self.evictions += 1
+
+    def _remove(self, key):
+        try:
+            os.remove(self._get_filename(key))
+        except OSError:
+            pass
+
+    def _get_filename(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        fd, tmp_filename = tempfile.mkstemp(suffix = '.json', dir = self.directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_filename, os.path.join(self.directory, INDEX_FILE))
+
+    @contextlib.contextmanager
+    def _lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -13,6 +13,7 @@ import numpy as np
 #,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,
 # Numerical parameters
 EPS = np.finfo(np.float32).eps
+RAYLEIGH_THRESHOLD = 0.1 # Max. |m| * size parameter for the Rayleigh approximation
 
 #,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,
 # Physical parameters
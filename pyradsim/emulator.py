@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jun 24 10:12:41 2016
+
+@author: wolfensb
+"""
+
+from collections import OrderedDict
+import numpy as np
+
+from pyradsim.tmatrix import POL_VAR_UNITS, POL_VAR_NAMES
+from pyradsim.utilities import PolVars
+from pyradsim.box import POL_VAR_DIMENSIONS
+
+def _rbf_matrix(x1, x2):
+    # Cubic radial basis functions phi(r) = r^3 between the points x1 (n1, k)
+    # and the centers x2 (n2, k)
+    d = np.sqrt(np.sum((x1[:,None,:] - x2[None,:,:])**2, axis = 2))
+    return d**3
+
+def _poly_matrix(x):
+    # Linear polynomial tail of the RBF interpolant: 1, x_1, ..., x_k
+    return np.hstack((np.ones((len(x),1)), x))
+
+def fit_rbf(x, y, smoothing = 0):
+    # Coefficients (n + k + 1, m) of the cubic RBF interpolant with linear
+    # tail of the outputs y (n, m) at the points x (n, k), smoothing > 0 gives
+    # a regression instead of an interpolation (noisy outputs)
+    n, k = x.shape
+    P = _poly_matrix(x)
+    A = np.zeros((n + k + 1, n + k + 1))
+    A[:n,:n] = _rbf_matrix(x, x) + smoothing * np.eye(n)
+    A[:n,n:] = P
+    A[n:,:n] = P.T
+    rhs = np.zeros((n + k + 1, y.shape[1]))
+    rhs[:n] = y
+    try:
+        return np.linalg.solve(A, rhs)
+    except np.linalg.LinAlgError: # Duplicate points or flat parameter
+        return np.linalg.lstsq(A, rhs, rcond = None)[0]
+
+def eval_rbf(x, centers, coefs):
+    n = len(centers)
+    return np.dot(_rbf_matrix(x, centers), coefs[:n]) + np.dot(_poly_matrix(x), coefs[n:])
+
+def get_sens_design(dic_sens, box = None):
+    # Points (n, k), parameter names and outputs (var : (n, ...)) of the
+    # results of a sensitivity analysis, either a sampling ('lhs', 'sobol')
+    # or a full grid ('parallel'), per box (box = name) or integrated
+    if 'samples' in dic_sens:
+        samples = dic_sens['samples']
+        outputs = dic_sens['outputs'] if box is None else dic_sens['outputs'][box]
+        names = list(samples.attributes['parameter'])
+        return np.asarray(samples,dtype = float), names, outputs
+
+    outputs = dic_sens if box is None else dic_sens[box]
+    first = outputs[list(outputs.keys())[0]]
+    # The dimensions of the parameters are followed by the ones of the 
+    # variables (e.g. frequency)
+    names = [p for p in first.attributes.keys() if p not in POL_VAR_DIMENSIONS]
+    values = [first.attributes[p] for p in names]
+    if len(first.attributes) != np.ndim(first):
+        raise ValueError('Only the results of the lhs, sobol or parallel sensitivity '+
+                         'analyses can be emulated')
+    # Grid points in the order of the flattened arrays
+    grid = np.meshgrid(*values, indexing = 'ij')
+    points = np.column_stack([g.ravel() for g in grid]).astype(float)
+    outputs = OrderedDict((k,np.reshape(np.asarray(v),(len(points),) +
+                                        np.shape(v)[len(names):]))
+                          for k,v in outputs.items())
+    return points, names, outputs
+
+class Emulator(object):
+    # Surrogate of the simulator over the parameters of a sensitivity
+    # analysis: cubic radial basis functions interpolant of all polarimetric
+    # variables, fitted on the simulated points. The parameters are
+    # normalized by their range. Queries return the same container as
+    # compute_pol_var
+    def __init__(self, names, points, outputs, smoothing = 0, n_folds = 5):
+        self.names = list(names)
+        self.points = np.asarray(points, dtype = float)
+        self.smoothing = smoothing
+
+        # All variables are fitted at once, one column per value
+        self.variables = list(outputs.keys())
+        self.shapes = [np.shape(outputs[k])[1:] for k in self.variables]
+        y = np.hstack([np.reshape(np.asarray(outputs[k],dtype = float),
+                                  (len(self.points),-1)) for k in self.variables])
+        valid = np.all(np.isfinite(y), axis = 1)
+        if not np.all(valid):
+            print(str(int(np.sum(~valid)))+' points with invalid outputs are ignored')
+        self.points = self.points[valid]
+        self.y = y[valid]
+
+        self.lower = np.min(self.points, axis = 0)
+        self.scale = np.max(self.points, axis = 0) - self.lower
+        self.scale[self.scale == 0] = 1 # Constant parameter
+        self.centers = self.normalize(self.points)
+        self.coefs = fit_rbf(self.centers, self.y, self.smoothing)
+        self._set_columns()
+        self.cv_error = self.cross_validate(n_folds) if n_folds else None
+
+    def normalize(self, x):
+        return (np.asarray(x, dtype = float) - self.lower) / self.scale
+
+    def _set_columns(self):
+        # Columns of every variable in the fitted outputs, precomputed to
+        # keep the queries fast
+        self._columns = []
+        i = 0
+        for k, shape in zip(self.variables, self.shapes):
+            size = int(np.prod(shape))
+            self._columns.append((k, slice(i, i + size), shape))
+            i += size
+
+    def split(self, y):
+        # Columns of y (n, nb of columns) or of one row y back to the 
+        # polarimetric variables
+        pol = PolVars(POL_VAR_UNITS, POL_VAR_NAMES)
+        lead = np.shape(y)[:-1]
+        for k, columns, shape in self._columns:
+            pol[k] = y[..., columns].reshape(lead + shape)
+        return pol
+
+    def cross_validate(self, n_folds = 5):
+        # Root mean square error of every variable, estimated by n_folds-fold
+        # cross-validation (leave-one-out if there are less points)
+        n = len(self.centers)
+        k = self.centers.shape[1]
+        n_folds = min(n_folds, n)
+        folds = np.array_split(np.random.RandomState(0).permutation(n), n_folds)
+        errors = np.zeros(self.y.shape) + np.nan
+        for f in folds:
+            train = np.setdiff1d(np.arange(n), f)
+            if len(train) < k + 1: # Not enough points for the linear tail
+                continue
+            coefs = fit_rbf(self.centers[train], self.y[train], self.smoothing)
+            errors[f] = eval_rbf(self.centers[f], self.centers[train], coefs) - self.y[f]
+        rmse = np.sqrt(np.nanmean(errors**2, axis = 0, keepdims = True))
+        return self.split(rmse[0])
+
+    def __call__(self, x):
+        # Polarimetric variables at the parameter vector x (nb of parameters)
+        # or at several ones (n, nb of parameters), in the order of names
+        x = np.asarray(x, dtype = float)
+        if x.shape[-1] != len(self.names):
+            raise ValueError('Emulator expects '+str(len(self.names))+' parameters: '+
+                             ', '.join(self.names))
+        y = eval_rbf(np.atleast_2d(self.normalize(x)), self.centers, self.coefs)
+        return self.split(y[0] if x.ndim == 1 else y)
+
+    def save(self, filename):
+        shapes = np.empty(len(self.shapes), dtype = object)
+        shapes[:] = self.shapes
+        np.savez(filename, names = np.array(self.names), points = self.points,
+                 y = self.y, variables = np.array(self.variables),
+                 shapes = shapes,
+                 coefs = self.coefs, lower = self.lower, scale = self.scale,
+                 smoothing = self.smoothing,
+                 cv_error = np.array([self.cv_error], dtype = object))
+
+    def __str__(self):
+        msg = 'Emulator of '+', '.join(self.variables)+'\n'
+        msg += 'Parameters: '+', '.join(self.names)+'\n'
+        msg += 'Fitted on '+str(len(self.points))+' points\n'
+        if self.cv_error is not None:
+            msg += 'Cross-validated RMSE:\n'+str(self.cv_error)
+        return msg
+
+def load_emulator(filename):
+    # Emulator saved with Emulator.save, nothing is refitted
+    data = np.load(filename, allow_pickle = True)
+    emulator = Emulator.__new__(Emulator)
+    emulator.names = list(data['names'])
+    emulator.points = data['points']
+    emulator.y = data['y']
+    emulator.variables = list(data['variables'])
+    emulator.shapes = [tuple(s) for s in data['shapes']]
+    emulator.coefs = data['coefs']
+    emulator.lower = data['lower']
+    emulator.scale = data['scale']
+    emulator.smoothing = float(data['smoothing'])
+    emulator.centers = emulator.normalize(emulator.points)
+    emulator._set_columns()
+    emulator.cv_error = data['cv_error'][0]
+    return emulator
+
+def create_emulator(dic_sens, box = None, smoothing = 0, n_folds = 5):
+    # Emulator of the results of SensSimulator.get_pol_vars (box = name of
+    # the box to emulate) or SensSimulator.get_integrated_pol_vars (box = None)
+    points, names, outputs = get_sens_design(dic_sens, box)
+    print('Fitting emulator on '+str(len(points))+' points')
+    return Emulator(names, points, outputs, smoothing, n_folds)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Jun 20 14:05:12 2016
+
+@author: wolfensb
+"""
+
+import os
+import tempfile
+import multiprocessing as mp
+import numpy as np
+
+from pyradsim.tmatrix import create_scatterer, compute_SZ
+
+# Shared memory is a tmpfs mounted on /dev/shm on linux
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Scatterers of the current process, indexed by the parameters of
+# create_scatterer
+_SCATTERERS = {}
+# Shared buffers the current process is writing to, indexed by filename and
+# inode (mkstemp reuses the names of removed files)
+_BUFFERS = {}
+
+def _get_scatterer(scatterer_params):
+    if scatterer_params not in _SCATTERERS:
+        _SCATTERERS[scatterer_params] = create_scatterer(*scatterer_params)
+    return _SCATTERERS[scatterer_params]
+
+def _init_worker(all_scatterer_params):
+    # Builds the scatterers that are already known once per worker
+    _SCATTERERS.clear()
+    for scatterer_params in all_scatterer_params:
+        _get_scatterer(scatterer_params)
+
+def _compute_SZ_task(task):
+    # task = (scatterer params, geometries, D, m, aspect ratio)
+    scatterer_params, geometries, D, m, ar = task
+    return compute_SZ(_get_scatterer(scatterer_params), geometries, D, m, ar)
+
+def _get_buffers(filename, shape, max_buffers = 16):
+    key = (filename, os.stat(filename).st_ino, tuple(shape))
+    if key not in _BUFFERS:
+        # Only keep the buffers of the current computations
+        if len(_BUFFERS) >= max_buffers:
+            _BUFFERS.clear()
+        _BUFFERS[key] = SharedBuffers.open_arrays(filename, shape)
+    return _BUFFERS[key]
+
+def _write_SZ_task(task):
+    # task = (buffers filename, buffers shape, row, scatterer params, geometries,
+    #         D, m, aspect ratio)
+    # The matrices are written in the shared buffers, nothing is sent back
+    filename, shape, row = task[0:3]
+    S_forw, Z_back = _compute_SZ_task(task[3:])
+    S, Z = _get_buffers(filename, shape)
+    S[row] = S_forw.reshape(S.shape[1:])
+    Z[row] = Z_back.reshape(Z.shape[1:])
+
+class SharedBuffers(object):
+    def __init__(self, shape):
+        """ Preallocated arrays of forward amplitude matrices (S, complex64)
+            and backward phase matrices (Z, float32) in shared memory, with
+            one row per diameter bin
+                - shape : shape of the arrays without the last dimension (4
+                  for S and 16 for Z), the first dimension are the bins
+        """
+        self.shape = tuple(shape)
+        fd, self.filename = tempfile.mkstemp(prefix = 'pyradsim_', suffix = '.buf',
+                                             dir = SHM_DIR)
+        os.close(fd)
+        self.S, self.Z = self.open_arrays(self.filename, self.shape, 'w+')
+
+    @staticmethod
+    def open_arrays(filename, shape, mode = 'r+'):
+        shape = tuple(shape)
+        S = np.memmap(filename, dtype = 'c8', mode = mode, shape = shape + (4,))
+        Z = np.memmap(filename, dtype = 'float32', mode = mode, shape = shape + (16,),
+                      offset = S.nbytes)
+        return S, Z
+
+    def release(self):
+        # Removes the file, the memory stays mapped as long as the arrays
+        # are referenced
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+        # Return arrays that are not tied to the file anymore
+        return np.asarray(self.S), np.asarray(self.Z)
+
+def create_executor(config):
+    if config is None:
+        config = {}
+    return ScatteringExecutor(config.get('processes'))
+
+class ScatteringExecutor(object):
+    def __init__(self, processes = None, scatterer_params = None):
+        """ Persistent pool of workers used for all T-matrix computations
+                - processes : number of workers, default is the number of
+                  cpus, if 1 all computations are done in the current process
+                - scatterer_params : list of parameters of create_scatterer
+                  for which a scatterer is built once in every worker
+            The pool is started at the first computation and must be
+            shut down with close()
+        """
+        self.processes = processes or mp.cpu_count()
+        self.scatterer_params = scatterer_params or []
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = mp.Pool(processes = self.processes,
+                                 initializer = _init_worker,
+                                 initargs = (self.scatterer_params,))
+        return self._pool
+
+    def compute_SZ(self, tasks):
+        # Returns the list of (S_forw, Z_back) for all tasks
+        tasks = list(tasks)
+        if self.processes == 1 or len(tasks) == 1:
+            return [_compute_SZ_task(t) for t in tasks]
+        # Send tasks by chunks, to limit inter-process communication
+        chunksize = int(np.ceil(len(tasks) / float(4 * self.processes)))
+        return self._get_pool().map(_compute_SZ_task, tasks, chunksize)
+
+    def compute_SZ_shared(self, tasks, shape = ()):
+        # Returns the arrays S (n_tasks, shape, 4) and Z (n_tasks, shape, 16), 
+        # the workers write directly in shared memory
+        # shape is the shape of the results of one task without the matrix 
+        # dimension, e.g. (n_elevations,) if the geometries are a list
+        return self.compute_SZ_batches([(tasks, shape)])[0]
+        
+    def compute_SZ_batches(self, batches):
+        # Same as compute_SZ_shared for a list of (tasks, shape), e.g. the
+        # tasks of several hydrometeors, all tasks are sent to the workers at
+        # once. Returns the list of (S, Z)
+        batches = [(list(tasks), tuple(shape)) for tasks, shape in batches]
+        n_tasks = sum([len(tasks) for tasks, shape in batches])
+        if self.processes == 1 or n_tasks <= 1:
+            out = []
+            for tasks, shape in batches:
+                S = np.zeros((len(tasks),) + shape + (4,), dtype = 'c8')
+                Z = np.zeros((len(tasks),) + shape + (16,), dtype = 'float32')
+                for i,t in enumerate(tasks):
+                    S_forw, Z_back = _compute_SZ_task(t)
+                    S[i] = S_forw.reshape(shape + (4,))
+                    Z[i] = Z_back.reshape(shape + (16,))
+                out.append((S, Z))
+            return out
+            
+        # One pair of shared buffers per batch
+        all_buffers = [SharedBuffers((len(tasks),) + shape) if len(tasks) else None
+                       for tasks, shape in batches]
+        try:
+            all_tasks = [(buffers.filename, buffers.shape, i) + tuple(t)
+                         for (tasks, shape), buffers in zip(batches, all_buffers)
+                         for i,t in enumerate(tasks)]
+            chunksize = int(np.ceil(len(all_tasks) / float(4 * self.processes)))
+            self._get_pool().map(_write_SZ_task, all_tasks, chunksize)
+        finally:
+            out = []
+            for (tasks, shape), buffers in zip(batches, all_buffers):
+                if buffers is None:
+                    out.append((np.zeros((0,) + shape + (4,), dtype = 'c8'),
+                                np.zeros((0,) + shape + (16,), dtype = 'float32')))
+                else:
+                    out.append(buffers.release())
+        return out
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def terminate(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        # The pool cannot be sent to other processes
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
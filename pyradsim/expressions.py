@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Jun 20 14:05:47 2016
+
+@author: wolfensb
+"""
+
+import ast
+import numpy as np
+
+# Functions that can be used without the np. prefix in the formulas
+MATH_FUNCTIONS = ['cos','sin','exp','log','log10','tan','abs','sqrt']
+
+# Compiled expressions, indexed by (normalized expression, arguments)
+_COMPILED = {}
+
+class _AddNumpyPrefix(ast.NodeTransformer):
+    # Replaces cos(D) by np.cos(D) and checks that all names are either
+    # arguments, math functions or np
+    def __init__(self, args):
+        self.args = args
+
+    def visit_Name(self, node):
+        if node.id in self.args or node.id == 'np':
+            return node
+        if node.id in MATH_FUNCTIONS:
+            return ast.copy_location(ast.Attribute(value = ast.Name(id = 'np', ctx = ast.Load()),
+                                                   attr = node.id, ctx = ast.Load()), node)
+        raise ValueError("Unknown name '"+node.id+"' in expression, valid names are "+
+                         ', '.join(list(self.args) + MATH_FUNCTIONS))
+
+class CompiledExpression(object):
+    # Vectorized function of the arguments (e.g. D, T, F) given by a formula,
+    # the formula is parsed and compiled only once
+    def __init__(self, source, args, tree):
+        self.source = source
+        self.args = args
+        self.code = compile(tree, '<'+source+'>', 'eval')
+
+    def __call__(self, *inputs):
+        return eval(self.code, {'np':np}, dict(zip(self.args, inputs)))
+
+    def __reduce__(self):
+        return (compile_expression, (self.source, self.args))
+
+    def __deepcopy__(self, memo):
+        # Immutable
+        return self
+
+def compile_expression(source, args):
+    # Returns the compiled expression of the formula source, as a function of
+    # args (tuple of argument names), formulas that are identical up to the
+    # formatting share the same compiled expression
+    args = tuple(args)
+    tree = ast.parse(str(source).strip(), mode = 'eval')
+    tree = ast.fix_missing_locations(_AddNumpyPrefix(args).visit(tree))
+    key = (ast.dump(tree), args)
+    if key not in _COMPILED:
+        _COMPILED[key] = CompiledExpression(str(source), args, tree)
+    return _COMPILED[key]
@@ -6,51 +6,140 @@ Created on Mon May 23 17:54:25 2016
 """
 
 import numpy as np
-import multiprocessing as mp
 from collections import OrderedDict
 import json
-import gc
 
-from  pyradsim.tmatrix import  flatten_matrices, create_scatterer, compute_pol_var
+from  pyradsim.tmatrix import  get_geometries, compute_pol_var, compute_SZ_rayleigh
+from  pyradsim.tmatrix import  get_size_parameter
+from  pyradsim.executor import ScatteringExecutor
+from  pyradsim.lut import select_lut
+from  pyradsim.psd import PSD
+from  pyradsim.permittivity_models import PermittivityModel, get_permittivity_source
+from  pyradsim.permittivity_models import set_permittivity_table
 import  pyradsim.constants as constants
 
 MATH_FUNCTIONS = ['cos','sin','exp','log','log10','tan']
 
-global GEOM
-global SCATT
+# Absolute values under which the errors of the adaptive quadrature are not
+# relative anymore
+INTEG_ERROR_FLOOR = {'Zh':constants.EPS,'Zdr':constants.EPS,'Kdp':1E-3}
+
+# Default settings of the orientation quadrature
+ORIENT_TOLERANCE = 1E-3
+ORIENT_N_MAX = 32
+
+# Max. number of nodes of the master diameter grid, in multiples of nbins_d,
+# beyond which the grid is rebuilt with nbins_d nodes on the whole range
+GRID_MAX_FACTOR = 2
 
 from tictoc import tic,toc
 
+def get_values(value):
+    # A single value or a tuple of values (e.g. elevation angles or
+    # frequencies), tuples can be used in the scatter signature
+    if np.ndim(value) > 0:
+        return tuple([float(v) for v in value])
+    return value
+    
+def get_pol_var_frequency(frequency, elevation_angle):
+    # Frequency with the shape needed by compute_pol_var for matrices with
+    # a frequency dimension followed by an optional elevation dimension
+    if np.ndim(frequency) == 0:
+        return frequency
+    return np.reshape(frequency, (-1,) + (1,) * np.ndim(elevation_angle))
+    
+def clenshaw_curtis(n):
+    # Nodes (increasing) and weights of the Clenshaw-Curtis quadrature with n
+    # intervals (n + 1 nodes, n even) on [-1, 1]. The nodes with n intervals
+    # are the even nodes with 2n intervals
+    theta = np.pi * np.arange(n, -1, -1) / n
+    w = np.ones(n + 1)
+    for k in range(1, n // 2 + 1):
+        b = 1. if 2 * k == n else 2.
+        w -= b * np.cos(2 * k * theta) / (4 * k**2 - 1)
+    w *= 2. / n
+    w[0] /= 2
+    w[-1] /= 2
+    return np.cos(theta), w
+    
+def get_orientation_quadrature(hydro_specs):
+    # Settings of the orientation quadrature, either None (default quadrature)
+    # or (tolerance, n_max), see tmatrix.get_orientation_quadrature
+    settings = hydro_specs.get('orientation_quadrature')
+    if settings is None:
+        return None
+    if not isinstance(settings,dict):
+        settings = {'tolerance':settings}
+    return (float(settings.get('tolerance',ORIENT_TOLERANCE)),
+            int(settings.get('n_max',ORIENT_N_MAX)))
+    
 class Hydrometeor(object):
-    def __init__(self,name,hydro_specs, frequency, temperature, elevation_angle, nbins_d):
+    def __init__(self,name,hydro_specs, frequency, temperature, elevation_angle, nbins_d,
+                 cache = None, luts = None, executor = None, integration = None,
+                 rayleigh_threshold = constants.RAYLEIGH_THRESHOLD,
+                 permittivity_table = None):
         self.name = name
+        # Bins with |m| * size parameter below this threshold are computed
+        # with the Rayleigh approximation instead of the T-matrix method
+        self.rayleigh_threshold = rayleigh_threshold
+        # Tabulation of the permittivity models, None or (resolution_T,
+        # resolution_F, interpolation)
+        self.permittivity_table = permittivity_table
+        # Integration on the PSD, method is either 'trapz' (nbins_d regular
+        # bins) or 'gauss' (adaptive nested Clenshaw-Curtis quadrature)
+        self.integration = integration or {'method':'trapz'}
+        self.executor = executor # Pool of workers for T-matrix computations
+        self.cache = cache # On-disk cache of scattering matrices (optional)
+        self.luts = luts or [] # Precomputed scattering lookup tables (optional)
         
         self.psd = hydro_specs['psd']
         self.aspect_ratio = hydro_specs['aspect_ratio']
         self.canting_angle_std = hydro_specs['canting_angle_std']
         self.permittivity = hydro_specs['permittivity']
+        set_permittivity_table(self.permittivity, self.permittivity_table)
+        # 'fixed' (quadrature) or 'analytic' (closed-form moments)
+        self.orientation_averaging = hydro_specs.get('orientation_averaging','fixed')
+        self.orientation_quadrature = get_orientation_quadrature(hydro_specs)
         
-        self.theta = elevation_angle
-        self.frequency = frequency
+        self.theta = get_values(elevation_angle)
+        self.frequency = get_values(frequency)
         self.temperature = temperature
         self.nbins_d = nbins_d
         
         self._scatter_signature = None
-#        self._integ_signature = None
+        self._integ_signature = None
+        
+        self.list_D = None # Master diameter grid of the scattering matrices
+        self._grid_step = None
+        self._gauss_SZ = {} # Scattering matrices on the quadrature nodes
+        self._gauss_signature = None # Scatter signature of self._gauss_SZ
+        self.integration_error = None
         
         self._S = None
         self._Z = None
         self._integ_S = None
         self._integ_Z = None
+        self._integ_weights = None # Last trapezoidal weights (key, weights)
+        self._integ_outdated = True # Integrated S and Z must be recomputed
     
-    def update(self,hydro_specs, frequency, temperature, elevation_angle, nbins_d):
+    def update(self,hydro_specs, frequency, temperature, elevation_angle, nbins_d,
+               integration = None, rayleigh_threshold = constants.RAYLEIGH_THRESHOLD,
+               permittivity_table = None):
+        self.integration = integration or {'method':'trapz'}
+        self.rayleigh_threshold = rayleigh_threshold
+        self.permittivity_table = permittivity_table
+        self._integ_outdated = True
         self.psd = hydro_specs['psd']
         self.aspect_ratio = hydro_specs['aspect_ratio']
         self.canting_angle_std = hydro_specs['canting_angle_std']
         self.permittivity = hydro_specs['permittivity']
+        set_permittivity_table(self.permittivity, self.permittivity_table)
+        # 'fixed' (quadrature) or 'analytic' (closed-form moments)
+        self.orientation_averaging = hydro_specs.get('orientation_averaging','fixed')
+        self.orientation_quadrature = get_orientation_quadrature(hydro_specs)
         
-        self.theta = elevation_angle
-        self.frequency = frequency
+        self.theta = get_values(elevation_angle)
+        self.frequency = get_values(frequency)
         self.temperature = temperature
         self.nbins_d = nbins_d
         
@@ -58,34 +147,80 @@ class Hydrometeor(object):
         dic = OrderedDict([('Hydrometeor name',self.name),('PSD',self.psd.get_dic()),
                            ('Aspect ratio',self.aspect_ratio.expression),
                             ('Canting angle std',self.canting_angle_std),
+                            ('Orientation averaging',self.orientation_averaging),
+                            ('Orientation quadrature',self.orientation_quadrature),
                             ('Permittitivity',self.permittivity.expression)])
         msg = json.dumps(dic,indent=3) +'\n'
         return msg
         
+    def get_scatter_signature(self):
+        # The PSD range is not part of the signature: scattering is computed
+        # on a master diameter grid which is extended when needed. The 
+        # permittivity source (exact models or tables and their settings) is,
+        # the refractive indexes differ slightly
+        return (self.aspect_ratio.expression,
+                self.canting_angle_std,self.orientation_averaging,
+                self.orientation_quadrature,
+                self.permittivity.expression,get_permittivity_source(self.permittivity),
+                self.theta,self.get_scatter_temperature(),
+                self.frequency,self.nbins_d,self.rayleigh_threshold)
+        
+    def get_scatter_temperature(self):
+        # Temperature of the scatter signature, with tabulated permittivity
+        # models and nearest interpolation, all temperatures of a cell of the
+        # table give the same scattering and share the matrices
+        model = getattr(self.permittivity,'lambda_f',None)
+        if isinstance(model, PermittivityModel):
+            return model.get_temperature(self.temperature)
+        return self.temperature
+        
     def _set_scatter_signature(self):
-        self._scatter_signature = (self.psd.dmin,self.psd.dmax,self.aspect_ratio.expression,
-                                   self.canting_angle_std,self.permittivity.expression,
-                                   self.theta,self.temperature,self.frequency,self.nbins_d)
-        
-#    def _set_integ_signature(self):
-#        self._integ_signature = (self.psd.dmin,self.psd.dmax,self.aspect_ratio.expression,
-#                                   self.canting_angle_std,self.permittivity.expression,
-#                                   self.theta,self.temperature,self.frequency,self.nbins_d)
+        self._scatter_signature = self.get_scatter_signature()
+        
+    def get_integ_signature(self):
+        # Everything the integrated matrices depend on besides the scattering
+        # matrices: the PSD (object and content, including its range), the
+        # temperature and the integration settings
+        return (id(self.psd),self.psd.get_signature(),self.temperature,
+                tuple(sorted(self.integration.items())))
+        
+    def _set_integ_signature(self):
+        self._integ_signature = self.get_integ_signature()
+        
+    def is_integ_outdated(self):
+        # True if the integrated matrices must be recomputed, because the
+        # scattering matrices or the PSD changed (also when the PSD is 
+        # replaced or modified without update)
+        if self._integ_outdated:
+            return True
+        if self.integration.get('method','trapz') == 'gauss':
+            if self._gauss_signature != self.get_scatter_signature():
+                return True
+        elif self.is_scatter_outdated():
+            return True
+        return self._integ_signature != self.get_integ_signature()
+        
     def get_pol_vars(self):
-        # Scattering
-        S, Z = self.get_SZ()
-            
-        # Integration on DSD
+        # Integration on DSD, the scattering matrices are computed when needed
         integ_S, integ_Z = self.get_SZ_integrated()
      
-        pol = compute_pol_var(integ_S,integ_Z,self.frequency)  
+        pol = compute_pol_var(integ_S,integ_Z,get_pol_var_frequency(self.frequency,
+                                                                    self.theta))
         
         return pol
   
     def get_SZ_integrated(self):
+        # The last results are reused as long as the hydrometeor and its
+        # scattering matrices are unchanged
+        if not self.is_integ_outdated():
+            return self._integ_S, self._integ_Z
+        self._integ_outdated = True
+        if self.integration.get('method','trapz') == 'gauss':
+            return self.get_SZ_integrated_gauss(**dict((k,v) for k,v in
+                                     self.integration.items() if k != 'method'))
         
-        # Get amplitude and phase matrices
-        S, Z = self.get_SZ()
+        # Get amplitude and phase matrices on the PSD range
+        list_D, S, Z = self.get_SZ_on_range(self.psd.dmin,self.psd.dmax)
         
 #        outdated_psd = False
 #        if self._integ_signature is None:
@@ -94,90 +229,439 @@ class Hydrometeor(object):
 #            outdated_psd = True
 #        
 #        if outdated_psd:
-        list_D = np.linspace(self.psd.dmin,self.psd.dmax,self.nbins_d)
         
         N = self.psd(list_D,self.temperature)
-
-        integ_S=np.trapz(S*N[:,None],dx=list_D[1]-list_D[0],axis=0)# multiply by integration step
-        integ_Z=np.trapz(Z*N[:,None],dx=list_D[1]-list_D[0],axis=0) # multiply by integration step
+        integ_S, integ_Z = self._integrate(N[None,:], list_D, S, Z)
         
-        self._integ_S = integ_S
-        self._integ_Z = integ_Z
-        
-        del N
-        gc.collect()
+        self._integ_S = integ_S[0]
+        self._integ_Z = integ_Z[0]
+        self._integ_outdated = False
+        self._set_integ_signature()
 
         return self._integ_S, self._integ_Z
-
-    def get_SZ(self):
         
-        # Check if outdated
-        outdated_scatter = False
-        if self._scatter_signature is None:
-            outdated_scatter = True
-        elif self._scatter_signature != (self.psd.dmin,self.psd.dmax,self.aspect_ratio.expression,
-                                   self.canting_angle_std,self.permittivity.expression,
-                                   self.theta,self.temperature,self.frequency,self.nbins_d):
-            outdated_scatter = True
-        if outdated_scatter:
-            wavelength=constants.C/(self.frequency*1E09)*1000 # in mm
-
-            orientation_std = self.canting_angle_std
-            
-            list_D = np.linspace(self.psd.dmin,self.psd.dmax,self.nbins_d)
+    def get_SZ_integrated_gauss(self, tolerance = 1E-3, n_start = 8, n_max = 512):
+        # Integration on the PSD with nested Clenshaw-Curtis quadratures of
+        # increasing order (n_start, 2*n_start,... intervals) until the 
+        # relative change of Zh, Zdr and Kdp is below the tolerance, the
+        # estimated error is stored in self.integration_error. The nodes of
+        # a quadrature are also nodes of the next one, only the new nodes
+        # are computed. The matrices on the nodes have their own signature,
+        # the one of the master grid is left unchanged
+        if self._gauss_signature != self.get_scatter_signature():
+            self._gauss_SZ = {}
+            self._gauss_signature = self.get_scatter_signature()
             
-            # Aspect ratio and dielectric constant
-            all_ar = self.aspect_ratio(list_D)
-            all_m = self.permittivity(self.temperature,self.frequency,list_D)
-
-            if not isinstance(all_m,np.ndarray):
-                all_m = np.ones(list_D.shape) * all_m
-                
-            global SCATT
-            # Initialize SCATTerer
-            SCATT = create_scatterer(wavelength,orientation_std)
+        dmin = self.psd.dmin
+        dmax = self.psd.dmax
+        
+        n = n_start
+        previous = None
+        while True:
+            list_D, w, S, Z = self._get_SZ_clenshaw_curtis(dmin, dmax, n)
             
-            global GEOM
+            wN = (w * self.psd(list_D,self.temperature)).reshape((-1,) + (1,) * (S.ndim - 1))
+            integ_S = np.sum(S * wN, axis = 0)
+            integ_Z = np.sum(Z * wN, axis = 0)
             
-            # Define GEOMetries
-            GEOM = {} 
-            GEOM['back'] = (90-self.theta, 180-(90-self.theta), 0., 180, 0.0,0.0) # Backward
-            GEOM['forw'] = (90-self.theta, 90-self.theta, 0., 0.0, 0.0,0.0) # Forward
+            pol = compute_pol_var(integ_S, integ_Z, get_pol_var_frequency(self.frequency,
+                                                                          self.theta))
+            if previous is not None:
+                error = OrderedDict()
+                for k in ['Zh','Zdr','Kdp']:
+                    # Max. over all elevation angles
+                    error[k] = np.max(np.abs(pol[k] - previous[k]) / np.maximum(np.abs(pol[k]),
+                                      INTEG_ERROR_FLOOR[k]))
+                if max(error.values()) < tolerance:
+                    break
+                if 2 * n > n_max:
+                    print('Quadrature for '+self.name+' did not converge with '+
+                          str(n + 1)+' nodes!')
+                    break
+            previous = pol
+            n *= 2
             
-
-            # Initialize computing pool
-            pool = mp.Pool(processes = mp.cpu_count(),maxtasksperchild=1)
+        self.integration_error = error
+        print('Quadrature for '+self.name+' with '+str(n + 1)+' nodes, estimated'+
+              ' relative errors : '+', '.join([k+' = {:.2E}'.format(v) for k,v in error.items()]))
+              
+        self._integ_S = integ_S
+        self._integ_Z = integ_Z
+        self._integ_outdated = False
+        self._set_integ_signature()
+        return self._integ_S, self._integ_Z
+        
+    def _get_SZ_clenshaw_curtis(self, dmin, dmax, n):
+        # Nodes, weights and scattering matrices of the Clenshaw-Curtis 
+        # quadrature with n intervals on [dmin, dmax]. The matrices of the
+        # finest quadrature are kept for every range, the nodes of coarser
+        # ones are a subset of them
+        key = (dmin, dmax)
+        if key in self._gauss_SZ and not (self._gauss_SZ[key][0] % n == 0 or
+                                          n % self._gauss_SZ[key][0] == 0):
+            del self._gauss_SZ[key] # Quadratures are not nested
+        if key in self._gauss_SZ and self._gauss_SZ[key][0] >= n:
+            n_done, list_D, S, Z = self._gauss_SZ[key]
+            step = n_done // n
+            list_D, S, Z = list_D[::step], S[::step], Z[::step]
+        else:
+            x, _ = clenshaw_curtis(n)
+            list_D = 0.5 * (dmax - dmin) * x + 0.5 * (dmax + dmin)
+            if key in self._gauss_SZ:
+                # Previous quadrature on the even nodes, new ones on odd nodes
+                n_done, _, S_done, Z_done = self._gauss_SZ[key]
+                step = n // n_done
+                new = np.mod(np.arange(n + 1), step) != 0
+                S = np.zeros((n + 1,) + S_done.shape[1:], dtype = S_done.dtype)
+                Z = np.zeros((n + 1,) + Z_done.shape[1:], dtype = Z_done.dtype)
+                S[::step] = S_done
+                Z[::step] = Z_done
+                S[new], Z[new] = self._compute_SZ(list_D[new])
+            else:
+                S, Z = self._compute_SZ(list_D)
+            self._gauss_SZ[key] = (n, list_D, S, Z)
+        w = 0.5 * (dmax - dmin) * clenshaw_curtis(n)[1]
+        return list_D, w, S, Z
+        
+    def get_SZ_integrated_batch(self, psds, list_D = None):
+        # Integrates S and Z for many PSDs at once with one matrix product,
+        # psds is either a list of PSD objects, a PSD with arrays of
+        # parameters or a (n_psd, nbins) matrix of N(D) values at the
+        # diameters list_D (default is the master grid self.list_D). Returns integ_S and integ_Z with a leading PSD
+        # dimension, which can be given directly to compute_pol_var. The
+        # integration is always trapezoidal, whatever self.integration
+        if isinstance(psds, np.ndarray):
+            N = np.atleast_2d(psds)
+            if list_D is None:
+                S, Z = self.get_SZ()
+                list_D = self.list_D
+            else:
+                list_D = np.asarray(list_D, dtype = float)
+                self.get_SZ(np.min(list_D), np.max(list_D))
+                S, Z = self._interpolate_SZ(list_D)
+            if N.shape[1] != len(list_D):
+                raise ValueError('N(D) matrix has '+str(N.shape[1])+' bins but '+
+                                 str(len(list_D))+' diameters were given')
+        elif isinstance(psds, PSD):
+            # All parameter sets in one call
+            list_D, S, Z = self.get_SZ_on_range(psds.dmin, psds.dmax)
+            N = np.atleast_2d(psds(list_D, self.temperature))
+        else:
+            # PSDs with the same range are integrated together on the nodes
+            # of this range, as in get_SZ_integrated
+            groups = OrderedDict()
+            for i, psd in enumerate(psds):
+                groups.setdefault((psd.dmin, psd.dmax), []).append(i)
+            # The master grid is extended once for all ranges
+            self.get_SZ(min([k[0] for k in groups]), max([k[1] for k in groups]))
             
-            SZ=list(pool.map(get_SZ_by_D,zip(list_D,all_m,all_ar)))
+            integ_S = None
+            for (dmin, dmax), idx in groups.items():
+                list_D, S, Z = self.get_SZ_on_range(dmin, dmax)
+                N = np.array([psds[i](list_D, self.temperature) for i in idx])
+                group_S, group_Z = self._integrate(N, list_D, S, Z)
+                if integ_S is None:
+                    integ_S = np.zeros((len(psds),) + group_S.shape[1:], dtype = group_S.dtype)
+                    integ_Z = np.zeros((len(psds),) + group_Z.shape[1:], dtype = group_Z.dtype)
+                integ_S[idx] = group_S
+                integ_Z[idx] = group_Z
+            return integ_S, integ_Z
+        
+        return self._integrate(N, list_D, S, Z)
+        
+    def _integrate(self, N, list_D, S, Z):
+        # Trapezoidal integration of S and Z for all rows of N
+        wN = N * self._get_integration_weights(list_D)
+        n = len(list_D)
+        integ_S = np.dot(wN, S.reshape((n,-1))).reshape((len(N),) + S.shape[1:])
+        integ_Z = np.dot(wN, Z.reshape((n,-1))).reshape((len(N),) + Z.shape[1:])
+        return integ_S, integ_Z
+        
+    def _get_integration_weights(self, list_D):
+        # Trapezoidal weights on list_D, the last ones are kept since they are
+        # reused for every PSD with the same range
+        key = list_D.tobytes()
+        if self._integ_weights is None or self._integ_weights[0] != key:
+            dD = np.diff(list_D)
+            w = np.zeros(len(list_D))
+            w[:-1] += 0.5 * dD
+            w[1:] += 0.5 * dD
+            self._integ_weights = (key, w)
+        return self._integ_weights[1]
+        
+    def get_SZ_on_range(self, dmin, dmax):
+        # Diameters and scattering matrices covering exactly [dmin, dmax]: the
+        # nodes of the master grid inside the range, plus both limits where
+        # S and Z are linearly interpolated
+        S, Z = self.get_SZ(dmin, dmax)
+        
+        tol = 1E-6 * self._grid_step
+        inside = np.logical_and(self.list_D > dmin + tol, self.list_D < dmax - tol)
+        
+        list_D = np.concatenate(([dmin], self.list_D[inside], [dmax]))
+        S_lim, Z_lim = self._interpolate_SZ(np.array([dmin, dmax]))
+        S = np.concatenate((S_lim[0:1], S[inside], S_lim[1:2]))
+        Z = np.concatenate((Z_lim[0:1], Z[inside], Z_lim[1:2]))
+        return list_D, S, Z
+        
+    def _interpolate_SZ(self, list_D):
+        # Linear interpolation of S and Z on the master grid, S and Z are
+        # zero for D = 0
+        grid_D = np.concatenate(([0.], self.list_D))
+        idx = np.clip(np.searchsorted(grid_D, list_D) - 1, 0, len(grid_D) - 2)
+        t = (list_D - grid_D[idx]) / (grid_D[idx + 1] - grid_D[idx])
+        
+        S = np.concatenate((np.zeros((1,) + self._S.shape[1:], dtype = self._S.dtype), self._S))
+        Z = np.concatenate((np.zeros((1,) + self._Z.shape[1:], dtype = self._Z.dtype), self._Z))
+        t = t.reshape((-1,) + (1,) * (S.ndim - 1))
+        return (1 - t) * S[idx] + t * S[idx + 1], (1 - t) * Z[idx] + t * Z[idx + 1]
 
-            SZ = flatten_matrices(SZ)
+    def get_particle_properties(self, list_D):
+        # Aspect ratios and refractive indexes for a set of diameters, with
+        # several frequencies the refractive indexes are computed for all of
+        # them at once and have the shape (n_D, n_frequencies)
+        all_ar = self.aspect_ratio(list_D)
+        if np.ndim(self.frequency) > 0:
+            freqs = np.array(self.frequency)
+            all_m = self.permittivity(self.temperature,freqs[None,:],list_D[:,None])
+            all_m = np.ones((len(list_D),len(freqs))) * all_m
+        else:
+            all_m = self.permittivity(self.temperature,self.frequency,list_D)
     
-            self._S = SZ[0]
-            self._Z = SZ[1]
+        if not isinstance(all_m,np.ndarray):
+            all_m = np.ones(list_D.shape) * all_m
+        return all_ar, all_m
+        
+    def _get_grid_nodes(self, dmin, dmax):
+        # Nodes of the master grid needed to cover [dmin, dmax], the grid is
+        # anchored on its first node and has a constant step
+        origin = self.list_D[0]
+        kmin = int(np.floor((dmin - origin) / self._grid_step + 1E-6))
+        kmax = int(np.ceil((dmax - origin) / self._grid_step - 1E-6))
+        nodes = origin + np.arange(kmin, kmax + 1) * self._grid_step
+        return nodes[nodes > 0]
+        
+    def get_scatterer_params(self, frequency):
+        # Parameters of the T-matrix scatterer, see tmatrix.create_scatterer
+        wavelength=constants.C/(frequency*1E09)*1000 # in mm
+        return (wavelength,self.canting_angle_std,self.orientation_averaging,
+                self.orientation_quadrature)
+        
+    def get_all_scatterer_params(self):
+        return [self.get_scatterer_params(f) for f in np.atleast_1d(self.frequency)]
+        
+    def get_SZ_shape(self):
+        # Shape of the frequency and elevation dimensions of the scattering
+        # matrices, (n_frequencies, n_elevations) or a part of it
+        return np.shape(self.frequency) + np.shape(self.theta)
+        
+    def is_scatter_outdated(self):
+        if self._scatter_signature is None:
+            return True
+        return self._scatter_signature != self.get_scatter_signature()
+        
+    def set_SZ(self, S, Z, list_D, grid_step):
+        # Assigns scattering matrices computed elsewhere (e.g. by another
+        # hydrometeor with the same scatter signature), arrays are shared
+        if S is not self._S:
+            self._integ_outdated = True
+        self._S = S
+        self._Z = Z
+        self.list_D = list_D
+        self._grid_step = grid_step
+        self._set_scatter_signature()
+        
+    def get_SZ(self, dmin = None, dmax = None):
+        # Returns the scattering matrices on the master diameter grid
+        # (self.list_D), which covers at least [dmin, dmax] (default is the
+        # range of the PSD)
+        job = self.get_SZ_job(dmin, dmax)
+        if job is not None:
+            self.set_SZ_job(job, *self._compute_SZ(job[1]))
+        return self._S, self._Z
+        
+    def get_SZ_job(self, dmin = None, dmax = None):
+        # Diameters at which the scattering matrices must be computed for the
+        # master grid to cover [dmin, dmax]: None if there is nothing to
+        # compute, ('grid', list_D, grid_step) for a new grid or 
+        # ('extend', list_D, nb of nodes below the grid) for an extension.
+        # The results are assigned with set_SZ_job
+        if dmin is None:
+            dmin = self.psd.dmin
+        if dmax is None:
+            dmax = self.psd.dmax
             
-            self._set_scatter_signature()
+        # Check if outdated
+        if self.is_scatter_outdated():
+            # Create a new grid
+            return self._get_grid_job(dmin, dmax)
             
-            pool.close()
-
+        # Extend the grid if it does not cover the range
+        nodes = self._get_grid_nodes(dmin, dmax)
+        tol = 1E-6 * self._grid_step
+        lower = nodes[nodes < self.list_D[0] - tol]
+        upper = nodes[nodes > self.list_D[-1] + tol]
+        n_nodes = len(self.list_D) + len(lower) + len(upper)
+        if n_nodes > GRID_MAX_FACTOR * self.nbins_d:
+            # Too many nodes, new grid with nbins_d nodes on both ranges
+            return self._get_grid_job(min(dmin, self.list_D[0]), max(dmax, self.list_D[-1]))
+        if len(lower) or len(upper):
+            return ('extend', np.concatenate((lower, upper)), len(lower))
+        return None
+        
+    def _get_grid_job(self, dmin, dmax):
+        # New master grid of nbins_d regular nodes on [dmin, dmax], the
+        # scattering matrices are read from the on-disk cache if possible
+        grid_step = (dmax - dmin) / float(self.nbins_d - 1)
+        list_D = np.linspace(dmin, dmax, self.nbins_d)
+        
+        cached = None
+        if self.cache is not None:
+            # Try to read the matrices from the on-disk cache
+            cached = self.cache.get(self._get_cache_signature(list_D))
+        if cached is None:
+            return ('grid', list_D, grid_step)
+        self._set_grid(list_D, grid_step, cached['S'], cached['Z'])
+        return None
+        
+    def set_SZ_job(self, job, S, Z):
+        # Assigns the scattering matrices computed for a job of get_SZ_job
+        if job[0] == 'grid':
+            self._set_grid(job[1], job[2], S, Z)
+            if self.cache is not None:
+                self.cache.put(self._get_cache_signature(self.list_D), S = S, Z = Z)
+        else:
+            # Extended grids are not written to the on-disk cache, which
+            # only contains grids of nbins_d nodes
+            n = job[2]
+            lower, upper = job[1][:n], job[1][n:]
+            self.list_D = np.concatenate((lower, self.list_D, upper))
+            self._S = np.concatenate((S[:n], self._S, S[n:]))
+            self._Z = np.concatenate((Z[:n], self._Z, Z[n:]))
             
-        return self._S, self._Z
-    
-
-def get_SZ_by_D(params):
-    SCATT.m =  params[1]
-
-    SCATT.axis_ratio = params[2]
-    SCATT.radius = params[0]/2.0
-    
-    SCATT.set_geometry(GEOM['back'])
-    (S_back, Z_back) = SCATT.get_SZ_orient()
+    def _set_grid(self, list_D, grid_step, S, Z):
+        self.list_D = list_D
+        self._grid_step = grid_step
+        self._S = S
+        self._Z = Z
+        self._integ_outdated = True
+        self._set_scatter_signature()
+        
+    def _get_cache_signature(self, list_D):
+        # The matrices also depend on the lookup tables used to compute them
+        return self.get_scatter_signature() + (self.get_lut_signature(),
+                                               list_D[0], list_D[-1], len(list_D))
+        
+    def get_lut_signature(self):
+        # Signatures of the lookup tables selected for every frequency, None
+        # for frequencies without table
+        signature = []
+        for f in np.atleast_1d(self.frequency):
+            lut = select_lut(self.luts, f, self.orientation_averaging,
+                             self.orientation_quadrature)
+            signature.append(None if lut is None else lut.get_signature())
+        return tuple(signature)
+        
+    def _compute_SZ(self, list_D):
+        # Computes the scattering matrices for a set of diameters, with the
+        # Rayleigh approximation for small particles and from the lookup 
+        # tables or with the T-matrix method for the others
+        S, Z, tasks, tasks_idx = self.get_SZ_tasks(list_D)
+        S_tm, Z_tm = None, None
+        if len(tasks):
+            # Use the executor of the simulator, or a temporary one
+            executor = self.executor
+            if executor is None:
+                executor = ScatteringExecutor()
+                
+            S_tm, Z_tm = executor.compute_SZ_shared(tasks, np.shape(self.theta))
+            
+            if self.executor is None:
+                executor.close()
+        return self.set_SZ_tasks(S, Z, tasks_idx, S_tm, Z_tm)
+        
+    def get_SZ_tasks(self, list_D):
+        # Scattering matrices of the small particles (Rayleigh) and of the
+        # particles covered by the lookup tables, and T-matrix tasks of the
+        # other ones (see ScatteringExecutor), the T-matrix computations of
+        # all frequencies are done together. Returns S, Z, the tasks and 
+        # their (diameter, frequency) indexes in S and Z
+        
+        # Aspect ratio and dielectric constant
+        all_ar, all_m = self.get_particle_properties(list_D)
+        freqs = np.atleast_1d(self.frequency)
+        all_m = all_m.reshape(len(list_D),len(freqs))
+        
+        shape = (len(list_D),len(freqs)) + np.shape(self.theta)
+        S = np.zeros(shape + (4,), dtype = 'c8')
+        Z = np.zeros(shape + (16,), dtype = 'float32')
+        
+        tasks = []
+        tasks_idx = []
+        for i,f in enumerate(freqs):
+            wavelength=constants.C/(f*1E09)*1000 # in mm
+            m = all_m[:,i]
+            
+            # Size parameter scaled by the refractive index: the Rayleigh 
+            # approximation requires the particle to be small compared to the
+            # wavelength inside the particle too
+            small = np.abs(m) * get_size_parameter(list_D, wavelength) < \
+                        self.rayleigh_threshold
+            if np.any(small):
+                S[small,i], Z[small,i] = compute_SZ_rayleigh(wavelength, self.canting_angle_std,
+                                                 get_geometries(self.theta), list_D[small],
+                                                 m[small], all_ar[small],
+                                                 self.orientation_quadrature)
+            large = np.where(np.logical_not(small))[0]
+            if not len(large):
+                continue
+                
+            SZ_lut = self._interpolate_lut(f, list_D[large], all_ar[large], m[large])
+            if SZ_lut is not None:
+                S[large,i], Z[large,i] = SZ_lut
+                continue
+                
+            # Define geometries, for several elevation angles the T-matrix of
+            # every particle is computed once and used for all geometries
+            geometries = get_geometries(self.theta)
+            scatterer_params = self.get_scatterer_params(f)
+            tasks.extend([(scatterer_params,geometries,list_D[j],m[j],all_ar[j]) 
+                          for j in large])
+            tasks_idx.extend([(j,i) for j in large])
+        return S, Z, tasks, tasks_idx
+        
+    def set_SZ_tasks(self, S, Z, tasks_idx, S_tm, Z_tm):
+        # Puts the results of the T-matrix tasks of get_SZ_tasks in S and Z
+        if len(tasks_idx):
+            rows, cols = [np.array(idx) for idx in zip(*tasks_idx)]
+            S[rows,cols] = S_tm
+            Z[rows,cols] = Z_tm
+                
+        if np.ndim(self.frequency) == 0:
+            S = S[:,0]
+            Z = Z[:,0]
+        return S, Z
+        
+    def _interpolate_lut(self, frequency, list_D, all_ar, all_m):
+        # Scattering matrices from the lookup tables, None if no table covers
+        # all diameters
+        if not len(self.luts):
+            return None
+        # Tables computed with another orientation averaging are not used
+        lut = select_lut(self.luts, frequency, self.orientation_averaging,
+                         self.orientation_quadrature)
+        thetas = np.atleast_1d(self.theta)
+        if lut is None or not all([lut.covers(list_D, all_ar, all_m, 
+                                   self.canting_angle_std, t) for t in thetas]):
+            return None
+        if np.ndim(self.theta) == 0:
+            return lut.interpolate(list_D, all_ar, all_m, self.canting_angle_std, self.theta)
+        all_SZ = [lut.interpolate(list_D, all_ar, all_m, self.canting_angle_std, t)
+                  for t in thetas]
+        return (np.stack([SZ[0] for SZ in all_SZ], axis = 1),
+                np.stack([SZ[1] for SZ in all_SZ], axis = 1))
     
-    SCATT.set_geometry(GEOM['forw'])
-    (S_forw, Z_forw) = SCATT.get_SZ_orient()
 
-    return (S_forw,Z_back)
-    
-    
 if __name__ == '__main__':
     from parse import *
 
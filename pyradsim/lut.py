@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Jun 16 09:27:41 2016
+
+@author: wolfensb
+"""
+
+import itertools
+import hashlib
+import numpy as np
+from collections import OrderedDict
+
+import pyradsim.constants as constants
+from pyradsim.tmatrix import get_geometries, compute_pol_var
+from pyradsim.executor import ScatteringExecutor
+
+# Dimensions of the lookup tables, in this order
+LUT_AXES = ['D','aspect_ratio','m_real','m_imag','canting_angle_std','elevation_angle']
+
+# Relative tolerance used to match the frequency of a table
+FREQ_TOL = 1E-3
+
+def load_luts(config):
+    # Returns the list of lookup tables specified in the configuration file
+    if config is None or not config.get('lut'):
+        return []
+    filenames = config['lut']
+    if not isinstance(filenames,list):
+        filenames = [filenames]
+    return [ScatteringLUT.load(f) for f in filenames]
+
+def select_lut(luts, frequency, orientation_averaging = 'fixed',
+               orientation_quadrature = None):
+    # Returns the first lookup table computed at the specified frequency with
+    # the same orientation averaging, None if there is none
+    for lut in luts:
+        if abs(lut.frequency - frequency) > FREQ_TOL * frequency:
+            continue
+        if lut.orientation_averaging != orientation_averaging:
+            continue
+        if lut.orientation_quadrature != orientation_quadrature:
+            continue
+        return lut
+    return None
+    
+def get_quadrature_settings(value):
+    # Orientation quadrature settings as stored in the tables (empty array
+    # for the default quadrature) to (tolerance, n_max) or None
+    if value is None or np.size(value) == 0:
+        return None
+    return (float(value[0]), int(value[1]))
+
+class ScatteringLUT(object):
+    def __init__(self, frequency, axes, S, Z, orientation_averaging = 'fixed',
+                 orientation_quadrature = None):
+        """ Lookup table of forward amplitude matrices (S) and backward phase
+            matrices (Z) at a given frequency (in GHz).
+                - axes : dictionary of 1D grids, keys are given by LUT_AXES
+                - S : array of shape (grid shape, 4)
+                - Z : array of shape (grid shape, 16)
+                - orientation_averaging, orientation_quadrature : orientation
+                  averaging used to compute S and Z, see 
+                  tmatrix.create_scatterer
+        """
+        self.frequency = frequency
+        self.orientation_averaging = orientation_averaging
+        self.orientation_quadrature = get_quadrature_settings(orientation_quadrature)
+        self.axes = OrderedDict()
+        for ax in LUT_AXES:
+            self.axes[ax] = np.atleast_1d(np.asarray(axes[ax],dtype=float))
+        self.S = S
+        self.Z = Z
+        
+        # Interpolation is done on S/D**3 and Z/D**6 (Rayleigh scaling), which
+        # vary much more smoothly with the diameter than S and Z
+        D = self.axes['D'].reshape((-1,) + (1,) * (S.ndim - 1))
+        self._S_norm = S / D**3
+        self._Z_norm = Z / D**6
+        self._signature = None
+        
+    def get_signature(self):
+        # Hash of the content of the table, identifies the table in the
+        # signatures of the cached scattering matrices
+        if self._signature is None:
+            h = hashlib.sha1()
+            h.update(repr((self.frequency, self.orientation_averaging,
+                           self.orientation_quadrature)).encode())
+            for ax in self.axes.values():
+                h.update(ax.tobytes())
+            h.update(np.ascontiguousarray(self.S).tobytes())
+            h.update(np.ascontiguousarray(self.Z).tobytes())
+            self._signature = h.hexdigest()
+        return self._signature
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            axes = dict((ax, data[ax]) for ax in LUT_AXES)
+            # Tables without orientation settings were computed with the
+            # default quadrature
+            averaging = 'fixed'
+            if 'orientation_averaging' in data.files:
+                averaging = str(data['orientation_averaging'])
+            quadrature = None
+            if 'orientation_quadrature' in data.files:
+                quadrature = data['orientation_quadrature']
+            return cls(float(data['frequency']), axes, data['S'], data['Z'],
+                       averaging, quadrature)
+
+    def save(self, filename):
+        quadrature = self.orientation_quadrature
+        if quadrature is None:
+            quadrature = []
+        np.savez(filename, frequency = self.frequency, S = self.S, Z = self.Z,
+                 orientation_averaging = self.orientation_averaging,
+                 orientation_quadrature = np.array(quadrature, dtype = float),
+                 **self.axes)
+
+    def covers(self, D, aspect_ratio, m, canting_angle_std, elevation_angle):
+        # Checks if all inputs are within the limits of the table
+        values = self._get_points(D, aspect_ratio, m, canting_angle_std,
+                                  elevation_angle)
+        for i,ax in enumerate(self.axes.values()):
+            if len(ax) == 1:
+                if not np.allclose(values[:,i], ax[0]):
+                    return False
+            elif np.any(values[:,i] < ax[0]) or np.any(values[:,i] > ax[-1]):
+                return False
+        return True
+
+    def interpolate(self, D, aspect_ratio, m, canting_angle_std, elevation_angle):
+        # Multilinear interpolation of S and Z, vectorized over all diameters
+        points = self._get_points(D, aspect_ratio, m, canting_angle_std,
+                                  elevation_angle)
+        n_pts = points.shape[0]
+
+        # Lower index and weight along every non-singleton axis
+        idx = []
+        weights = []
+        dims = []
+        for i,ax in enumerate(self.axes.values()):
+            if len(ax) == 1:
+                idx.append(np.zeros(n_pts,dtype=int))
+                continue
+            i0 = np.clip(np.searchsorted(ax, points[:,i]) - 1, 0, len(ax) - 2)
+            t = (points[:,i] - ax[i0]) / (ax[i0 + 1] - ax[i0])
+            idx.append(i0)
+            weights.append(np.clip(t, 0, 1))
+            dims.append(i)
+
+        S = np.zeros((n_pts, 4), dtype = self.S.dtype)
+        Z = np.zeros((n_pts, 16), dtype = self.Z.dtype)
+        # Loop on the corners of the hypercube surrounding every point
+        for corner in itertools.product([0,1], repeat = len(dims)):
+            w = np.ones(n_pts)
+            corner_idx = list(idx)
+            for c,dim,t in zip(corner, dims, weights):
+                w *= t if c else 1 - t
+                corner_idx[dim] = idx[dim] + c
+            corner_idx = tuple(corner_idx)
+            S += w[:,None] * self._S_norm[corner_idx]
+            Z += w[:,None] * self._Z_norm[corner_idx]
+            
+        S *= points[:,0][:,None]**3
+        Z *= points[:,0][:,None]**6
+        return S, Z
+
+    def _get_points(self, D, aspect_ratio, m, canting_angle_std, elevation_angle):
+        D = np.atleast_1d(D)
+        m = np.broadcast_to(m, D.shape)
+        points = np.column_stack(np.broadcast_arrays(D, aspect_ratio, m.real, m.imag,
+                                 canting_angle_std, elevation_angle))
+        return points
+
+    def __str__(self):
+        msg = 'Scattering lookup table at '+str(self.frequency)+' GHz\n'
+        msg += 'Orientation averaging : '+self.orientation_averaging
+        if self.orientation_quadrature is not None:
+            msg += ', quadrature '+str(self.orientation_quadrature)
+        msg += '\n'
+        for ax in self.axes.keys():
+            msg += ax+' : '+str(len(self.axes[ax]))+' values in ['
+            msg += str(self.axes[ax][0])+', '+str(self.axes[ax][-1])+']\n'
+        return msg
+
+'''
+Tools to build and validate lookup tables
+'''
+
+def _get_task(wavelength, orientation_std, theta, D, m, ar, orientation_averaging = 'fixed',
+              orientation_quadrature = None):
+    return ((wavelength, orientation_std, orientation_averaging, orientation_quadrature),
+            get_geometries(theta), D, m, ar)
+
+def build_lut(frequency, D, aspect_ratio, m_real, m_imag, canting_angle_std,
+              elevation_angle, filename = None, executor = None,
+              orientation_averaging = 'fixed', orientation_quadrature = None):
+    # Computes S and Z with the T-matrix method on every node of the grid, 
+    # the table is only used for hydrometeors with the same orientation 
+    # averaging and quadrature
+    orientation_quadrature = get_quadrature_settings(orientation_quadrature)
+    axes = OrderedDict(zip(LUT_AXES,[D, aspect_ratio, m_real, m_imag,
+                                     canting_angle_std, elevation_angle]))
+    axes = OrderedDict((k, np.atleast_1d(np.asarray(v,dtype=float))) for k,v in axes.items())
+    shape = tuple([len(ax) for ax in axes.values()])
+    wavelength = constants.C/(frequency*1E09)*1000 # in mm
+
+    tasks = [_get_task(wavelength, p[4], p[5], p[0], complex(p[2], p[3]), p[1],
+                       orientation_averaging, orientation_quadrature)
+             for p in itertools.product(*axes.values())]
+    print('Building lookup table with '+str(len(tasks))+' nodes...')
+
+    if executor is None:
+        with ScatteringExecutor() as executor:
+            S, Z = executor.compute_SZ_shared(tasks)
+    else:
+        S, Z = executor.compute_SZ_shared(tasks)
+
+    S = S.reshape(shape + (4,))
+    Z = Z.reshape(shape + (16,))
+
+    lut = ScatteringLUT(frequency, axes, S, Z, orientation_averaging,
+                        orientation_quadrature)
+    if filename is not None:
+        lut.save(filename)
+    return lut
+
+def validate_lut(lut, n_samples = 50, seed = 0, executor = None):
+    # Compares the interpolated polarimetric variables of single particles
+    # with direct T-matrix computations at random points inside the table
+    # Returns the mean and max relative error for Zh, Zdr and Kdp
+    rng = np.random.RandomState(seed)
+    wavelength = constants.C/(lut.frequency*1E09)*1000 # in mm
+
+    samples = np.column_stack([rng.uniform(ax[0], ax[-1], n_samples)
+                               for ax in lut.axes.values()])
+    m = samples[:,2] + 1j * samples[:,3]
+    S_lut, Z_lut = lut.interpolate(samples[:,0], samples[:,1], m,
+                                   samples[:,4], samples[:,5])
+
+    tasks = [_get_task(wavelength, samples[i,4], samples[i,5], samples[i,0],
+                       m[i], samples[i,1], lut.orientation_averaging,
+                       lut.orientation_quadrature) for i in range(n_samples)]
+    if executor is None:
+        with ScatteringExecutor() as executor:
+            S_ref, Z_ref = executor.compute_SZ_shared(tasks)
+    else:
+        S_ref, Z_ref = executor.compute_SZ_shared(tasks)
+
+    errors = OrderedDict((k, []) for k in ['Zh','Zdr','Kdp'])
+    for i in range(n_samples):
+        pol_ref = compute_pol_var(S_ref[i], Z_ref[i], lut.frequency)
+        pol_lut = compute_pol_var(S_lut[i], Z_lut[i], lut.frequency)
+        for k in errors.keys():
+            errors[k].append(abs(pol_lut[k] - pol_ref[k]) / max(abs(pol_ref[k]), constants.EPS))
+
+    out = OrderedDict()
+    for k in errors.keys():
+        out[k] = {'mean': np.mean(errors[k]), 'max': np.max(errors[k])}
+    return out
+
+if __name__ == '__main__':
+    # Example: rain at C-band
+    lut = build_lut(5.6, np.linspace(0.1,8,80), np.linspace(1,1.8,9),
+                    np.linspace(7.5,9.5,5), np.linspace(1.2,2.6,5), [10],
+                    [0,10,20], filename = 'lut_rain_C.npz')
+    print(lut)
+    print(validate_lut(lut))
@@ -8,7 +8,6 @@ Created on Thu May 26 15:56:53 2016
 
 import collections
 import numbers
-import functools
 import numpy as np
 import re
 import yaml
@@ -16,10 +15,11 @@ import os
 import warnings
 
 from pyradsim.utilities import remove_tags, flatten_dic,remove_keys_with_none_values
-from pyradsim.permittivity_models import PERMITTITIVITY_MODELS
+from pyradsim.permittivity_models import MixturePermittivity, PermittivityModel
 from pyradsim.aspect_ratio_models import AR_MODELS
 from pyradsim.psd import PSD, BinnedPSD, create_PSD
 from pyradsim.utilities import Lambda, create_defaults
+from pyradsim.expressions import compile_expression
 
 _mapping_tag = yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG
 
@@ -33,7 +33,11 @@ yaml.add_representer(collections.OrderedDict, dict_representer)
 yaml.add_constructor(_mapping_tag, dict_constructor)
 
 
-MATH_FUNCTIONS = ['cos','sin','exp','log','log10','tan','abs']
+# References of the mixing rules of the permittivity
+MIXING_RULES = {'bohren_battan':"'Radar Backscattering by Inhomogeneous Precipitation Particles'"+
+                                " (Bohren and Battan, 1980)",
+                'maxwell_garnett':"'Colours in metal glasses and in metallic films'"+
+                                  " (Maxwell Garnett, 1904)"}
         
 def parse(input_type,*inputs):
     if input_type == 'psd':
@@ -158,20 +162,13 @@ def parse_config_file(filename):
     return config
 
         
-def parse_math_expression(string):
-    for func in MATH_FUNCTIONS:
-        if func in string:
-            string = string.replace(func,'np.'+func)
-    return string
-    
 def parse_psd(psd):
     flag = 0
     try:
         if isinstance(psd,str):
             if 'D' in psd or 'T' in psd:
                 flag = 1
-                psd_corr = parse_math_expression(psd)
-                out = PSD('custom',Lambda(eval('lambda D, T:'+psd_corr),psd_corr))
+                out = PSD('custom',Lambda(compile_expression(psd,('D','T')),psd))
                 # I guess we should try to run the function here...   
         elif isinstance(psd,list):
             if isinstance(psd[0],list) and isinstance(psd[1],list):
@@ -207,15 +204,14 @@ def parse_aspect_ratio(aspect_ratio):
             if aspect_ratio in AR_MODELS.keys():
                 out = AR_MODELS[aspect_ratio]
             elif 'D' in aspect_ratio:
-                aspect_ratio_corr = parse_math_expression(aspect_ratio)
-                expression = 'lambda D:'+ aspect_ratio_corr
-                out = Lambda(eval(expression),expression)
+                expression = 'lambda D:'+ aspect_ratio
+                out = Lambda(compile_expression(aspect_ratio,('D',)),expression)
                 # I guess we should try to run the function here...
             else:
                 flag = 0            
         elif isinstance(aspect_ratio,numbers.Number):
             expression = 'lambda D:(D>0)*'+str(aspect_ratio)
-            out = Lambda(eval(expression),expression)
+            out = Lambda(compile_expression('(D>0)*'+str(aspect_ratio),('D',)),expression)
         else:
             flag = 0
     except:
@@ -234,15 +230,14 @@ def parse_vol_fraction(vol_fraction):
     try:
         if isinstance(vol_fraction,str):
             if 'D' in vol_fraction or 'T' in vol_fraction:
-                vol_fraction_corr = parse_math_expression(vol_fraction)
-                expression = 'lambda D, T:'+vol_fraction_corr
-                out = Lambda(eval(expression),expression)
+                expression = 'lambda D, T:'+vol_fraction
+                out = Lambda(compile_expression(vol_fraction,('D','T')),expression)
                 # I guess we should try to run the function here...
             else:
                 flag = 0            
         elif isinstance(vol_fraction,numbers.Number):
             expression = 'lambda D, T:(D>0)*'+str(vol_fraction)
-            out = Lambda(eval(expression),expression)
+            out = Lambda(compile_expression('(D>0)*'+str(vol_fraction),('D','T')),expression)
         else:
             flag = 0
     except:
@@ -270,17 +265,14 @@ def parse_permittivity(diel_cst):
         if isinstance(diel_cst,str):
 
             if diel_cst == 'water':
-                expression = "lambda T, F, D: PERMITTITIVITY_MODELS['water'](T,F)"
-                out = Lambda(eval(expression),"Dielectric model for liq. water taken from 'A model for the complex permittivity of"+
+                out = Lambda(PermittivityModel('water'),"Dielectric model for liq. water taken from 'A model for the complex permittivity of"+
                 "water at frequencies below 1 THz' (Liebe,1991)")
             elif diel_cst == 'ice':
-                expression = "lambda T, F, D: PERMITTITIVITY_MODELS['ice'](T,F)"
-                out = Lambda(eval(expression),"Dielectric model for liq. water taken from 'A model for the complex permittivity of"+
+                out = Lambda(PermittivityModel('ice'),"Dielectric model for liq. water taken from 'A model for the complex permittivity of"+
                 "ice at frequencies below 1 THz' (Hufford,1991)")
             elif 'D' in diel_cst or 'T' in diel_cst or 'F' in diel_cst:
-                diel_cst_checked = parse_math_expression(diel_cst)
-                expression = 'lambda T, F, D:'+str(diel_cst_checked)
-                out = Lambda(eval(expression),expression)
+                expression = 'lambda T, F, D:'+diel_cst
+                out = Lambda(compile_expression(diel_cst,('T','F','D')),expression)
             else:
                 flag = 0                
              # I guess we should try to run the function here...
@@ -289,7 +281,7 @@ def parse_permittivity(diel_cst):
         ############################        
         elif isinstance(diel_cst,numbers.Number):
             expression = 'lambda T, F, D:(D>0)*'+str(diel_cst)
-            out = Lambda(eval(expression),expression)
+            out = Lambda(compile_expression('(D>0)*'+str(diel_cst),('T','F','D')),expression)
    
        # Case 3 : input is list
        ############################
@@ -297,9 +289,13 @@ def parse_permittivity(diel_cst):
             # When input is a list, it is assumed to be a list of two lists.
             # The first list contains the dielectric constants (any valid format)
             # and the second the vol. fraction relations (can be constants or 
-            # functions of D and T)
+            # functions of D and T), an optional third element gives the
+            # mixing rule ('bohren_battan' or 'maxwell_garnett')
             
-            if len(diel_cst) == 2 and len(diel_cst[0]) == len(diel_cst[1]):
+            if len(diel_cst) in [2,3] and len(diel_cst[0]) == len(diel_cst[1]):
+                rule = diel_cst[2] if len(diel_cst) == 3 else 'bohren_battan'
+                if rule not in MIXING_RULES.keys():
+                    raise ValueError('Invalid mixing rule: '+str(rule))
                 # First we read all the volumetric fractions
                 vol_frac_func = []
                 diel_func = []
@@ -308,15 +304,10 @@ def parse_permittivity(diel_cst):
                     vol_frac_func.append(parse_vol_fraction(component[0]))
                     diel_func.append(parse_permittivity(component[1]))
 
-                def func(vol_frac_func,T, F,D):
-                    frac = [v(D,T) for v in vol_frac_func]
-                    m = [m(T,F,D) for m in diel_func]
-                    return PERMITTITIVITY_MODELS['mixture'](frac, m)
-                expression = "Mixture model taken from 'Radar Backscattering by Inhomogeneous Precipitation Particles'"
-                expression+=" (Bohren and Battan, 1980), with "
+                expression = "Mixture model taken from "+MIXING_RULES[rule]+", with "
                 expression += 'vol fractions = '+' / '.join([v.expression for v in vol_frac_func])
                 expression += ' and dielectric constants = '+' / '.join([d.expression for d in diel_func])
-                out = Lambda(functools.partial(func, vol_frac_func),expression)      
+                out = Lambda(MixturePermittivity(vol_frac_func,diel_func,rule),expression)      
                 
             else:
                 flag = 0
@@ -6,6 +6,10 @@ Created on Wed Aug 19 14:54:56 2015
 """
 
 import numpy as np
+from collections import OrderedDict
+
+# Permittivity tables, indexed by (model, resolution_T, resolution_F, interpolation)
+_TABLES = {}
 
 def permittivity_ice(t,f):
    ## From the article of G.Hufford (1991): "A model for the complex permittivity 
@@ -70,47 +74,216 @@ def permittivity_water(t,f):
     m=np.sqrt(Epsilon)
     return m
     
-def permittivity_mixture(fracs, m):
-   ## From the article of Bohren and Battan : "Radar Backscattering by Inhomogeneous
-   # Precipitation Particles
+def permittivity_mixture(fracs, m, rule = 'bohren_battan'):
+   ## Effective complex refractive index of a mixture, the mixing is done on
+   ## the permittivities (m**2)
 
    ## Inputs :
-   ##   fracs = array containing the volume fraction of the inclusions
-   ##   m = array containing the permittivities of the inclusions
+   ##   fracs = volume fractions of the components, first dimension is the
+   ##           component, the other ones (e.g. diameters, temperatures,
+   ##           frequencies) are broadcasted with m
+   ##   m = complex refractive indexes of the components, same layout
+   ##   rule = 'bohren_battan' : the components are added one by one as
+   ##             inclusions in the previous mixture, from the article of
+   ##             Bohren and Battan : "Radar Backscattering by Inhomogeneous
+   ##             Precipitation Particles"
+   ##          'maxwell_garnett' : all other components are inclusions in the
+   ##             first one (matrix)
 
    ## Outputs :
    ##   m_mix = m' + im'' the complex refractive index of the mixture
 
    ## Source : D.Wolfensberger (November 2015)
 
-    if type(fracs)!=np.ndarray: # Convert to numpy array
-        fracs=np.asarray(fracs)
-
-    tot_frac=np.sum(fracs)
-    if tot_frac!=1:
-        fracs=fracs/tot_frac
-
-    fracs_stack=fracs[0]
-    m_mix=m[0]
-    idx=0
-
-    while idx<len(fracs)-1:
-        fracs_sub=np.asarray([fracs_stack,fracs[idx+1]])
-        m_sub=np.asarray([m_mix, m[idx+1]])
+    eps = np.asarray(m, dtype = complex)**2
+    fracs, eps = np.broadcast_arrays(np.asarray(fracs, dtype = float), eps)
+    
+    # Normalize the fractions for every diameter, temperature,...
+    tot_frac = np.sum(fracs, axis = 0)
+    fracs = fracs / np.where(tot_frac > 0, tot_frac, 1)
 
-        tot_frac=np.sum(fracs_sub)
-        if tot_frac!=1:
-            fracs_sub=fracs_sub/tot_frac
+    if rule == 'maxwell_garnett':
+        y = (eps[1:] - eps[0]) / (eps[1:] + 2 * eps[0])
+        fy = np.sum(fracs[1:] * y, axis = 0)
+        eps_mix = eps[0] * (1 + 2 * fy) / (1 - fy)
+    elif rule == 'bohren_battan':
+        eps_mix = eps[0]
+        frac_mix = fracs[0]
+        for idx in range(1, len(eps)):
+            # Volume fraction of the inclusion in the current mixture
+            frac_tot = frac_mix + fracs[idx]
+            f = np.divide(fracs[idx], frac_tot, out = np.zeros(frac_tot.shape),
+                          where = frac_tot > 0)
+            ratio = eps[idx] / eps_mix
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                beta = 2 / (ratio - 1) * (ratio / (ratio - 1) * np.log(ratio) - 1)
+            # Limit of beta for identical permittivities
+            beta = np.where(np.abs(ratio - 1) < 1E-6, 1., beta)
+            eps_mix = ((1 - f) * eps_mix + f * beta * eps[idx]) / (1 - f + f * beta)
+            frac_mix = frac_tot
+    else:
+        raise ValueError("Invalid mixing rule, use 'bohren_battan' or 'maxwell_garnett'")
+        
+    return np.sqrt(eps_mix)
+    
+class PermittivityTable(object):
+    # Memoized table of a permittivity model on a regular (T, F) grid with
+    # steps resolution_T (K) and resolution_F (GHz), the table is extended
+    # when needed and interpolated either with 'nearest' or 'linear'
+    def __init__(self, model, resolution_T = 0.5, resolution_F = 0.1,
+                 interpolation = 'linear'):
+        if interpolation not in ['nearest','linear']:
+            raise ValueError("Invalid interpolation, use 'nearest' or 'linear'")
+        self.model = model
+        self.resolution_T = float(resolution_T)
+        self.resolution_F = float(resolution_F)
+        self.interpolation = interpolation
+        self._i0 = None # Indexes of the first nodes in T and F
+        self._j0 = None
+        self._table = None
+        
+    def _extend(self, i_min, i_max, j_min, j_max):
+        # Makes sure that the nodes i_min...i_max (T) and j_min...j_max (F)
+        # are in the table, which is recomputed on the union of the ranges
+        if self._table is not None:
+            i1 = self._i0 + self._table.shape[0] - 1
+            j1 = self._j0 + self._table.shape[1] - 1
+            if i_min >= self._i0 and i_max <= i1 and j_min >= self._j0 and j_max <= j1:
+                return
+            i_min, i_max = min(i_min, self._i0), max(i_max, i1)
+            j_min, j_max = min(j_min, self._j0), max(j_max, j1)
+        T = np.arange(i_min, i_max + 1) * self.resolution_T
+        F = np.arange(j_min, j_max + 1) * self.resolution_F
+        self._table = PERMITTITIVITY_MODELS[self.model](T[:,None], F[None,:])
+        self._i0 = i_min
+        self._j0 = j_min
+        
+    def snap_temperature(self, T):
+        # Temperature of the node used with nearest interpolation
+        return np.round(np.asarray(T) / self.resolution_T) * self.resolution_T
+        
+    def __call__(self, T, F):
+        T, F = np.broadcast_arrays(np.asarray(T, dtype = float), np.asarray(F, dtype = float))
+        x = T / self.resolution_T
+        y = F / self.resolution_F
+        if self.interpolation == 'nearest':
+            i = np.round(x).astype(int)
+            j = np.round(y).astype(int)
+            self._extend(np.min(i), np.max(i), np.min(j), np.max(j))
+            return self._table[i - self._i0, j - self._j0]
+            
+        i = np.floor(x).astype(int)
+        j = np.floor(y).astype(int)
+        self._extend(np.min(i), np.max(i) + 1, np.min(j), np.max(j) + 1)
+        tx = x - i
+        ty = y - j
+        i = i - self._i0
+        j = j - self._j0
+        t = self._table
+        return ((1 - tx) * (1 - ty) * t[i, j] + tx * (1 - ty) * t[i + 1, j] +
+                (1 - tx) * ty * t[i, j + 1] + tx * ty * t[i + 1, j + 1])
+                
+def get_table_settings(settings):
+    # Settings of the tabulation of the permittivity models, settings is None 
+    # (the models are evaluated directly) or a dictionary with the keys
+    # resolution_T, resolution_F and interpolation
+    if settings is None:
+        return None
+    return (settings.get('resolution_T',0.5), settings.get('resolution_F',0.1),
+            settings.get('interpolation','linear'))
+    
+def get_permittivity_table(model, table_settings):
+    # Table of the model with the settings, None if not tabulated. Tables are
+    # kept for each setting
+    if table_settings is None:
+        return None
+    key = (model,) + tuple(table_settings)
+    if key not in _TABLES:
+        _TABLES[key] = PermittivityTable(model, *table_settings)
+    return _TABLES[key]
+        
+def get_permittivity(model, T, F, table_settings = None):
+    # Refractive index of the model ('water' or 'ice'), from the table if
+    # tabulation is enabled
+    table = get_permittivity_table(model, table_settings)
+    if table is None:
+        return PERMITTITIVITY_MODELS[model](T, F)
+    return table(T, F)
+    
+def get_permittivity_models(permittivity):
+    # All models (PermittivityModel) of a permittivity, which is either a
+    # model, a mixture or a Lambda of one of them
+    permittivity = getattr(permittivity,'lambda_f',permittivity)
+    if isinstance(permittivity, PermittivityModel):
+        return [permittivity]
+    if isinstance(permittivity, MixturePermittivity):
+        return [m for d in permittivity.diel_funcs for m in get_permittivity_models(d)]
+    return []
+    
+def set_permittivity_table(permittivity, table_settings):
+    # Assigns the tabulation settings (see get_table_settings) to all models
+    # of a permittivity
+    for model in get_permittivity_models(permittivity):
+        model.table_settings = table_settings
+        
+def get_permittivity_source(permittivity):
+    # Source of the refractive indexes of every model of a permittivity,
+    # 'exact' or the settings of its table, used in signatures of the 
+    # scattering matrices
+    return tuple([m.get_source() for m in get_permittivity_models(permittivity)])
+    
+class PermittivityModel(object):
+    # Refractive index of a model as a function of (T, F, D), tabulated with
+    # the settings table_settings (see get_table_settings) or not (None)
+    def __init__(self, model, table_settings = None):
+        self.model = model
+        self.table_settings = table_settings
+        
+    def __call__(self, T, F, D):
+        return get_permittivity(self.model, T, F, self.table_settings)
+        
+    def get_source(self):
+        if self.table_settings is None:
+            return 'exact'
+        return ('table',) + tuple(self.table_settings)
+        
+    def get_temperature(self, T):
+        # Temperature that gives the same refractive index as T: the node of
+        # the table with nearest interpolation, T itself otherwise
+        table = get_permittivity_table(self.model, self.table_settings)
+        if table is None or table.interpolation != 'nearest':
+            return T
+        return float(table.snap_temperature(T))
+        
+class MixturePermittivity(object):
+    # Refractive index of a mixture, the volume fractions are functions of
+    # (D, T) and the refractive indexes of (T, F, D). All components are
+    # evaluated and mixed at once, the results are cached per (T, F, D)
+    def __init__(self, vol_frac_funcs, diel_funcs, rule = 'bohren_battan', cache_size = 16):
+        self.vol_frac_funcs = vol_frac_funcs
+        self.diel_funcs = diel_funcs
+        self.rule = rule
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
         
-        beta=2*m_sub[0]/(m_sub[1]-m_sub[0])*(m_sub[1]/(m_sub[1]-m_sub[0])*np.log(m_sub[1]/m_sub[0])-1)
-        m_mix=((1-fracs_sub[1])*m_sub[0]+fracs_sub[1]*beta)/(1-fracs_sub[1]+fracs_sub[1]*beta)
-        idx+=1
-        fracs_stack+=fracs[1]
+    def __call__(self, T, F, D):
+        key = tuple((np.shape(x), np.asarray(x).tobytes()) for x in (T, F, D))
+        key += (get_permittivity_source(self),)
+        if key in self._cache:
+            return self._cache[key]
+            
+        shape = np.broadcast(np.asarray(T), np.asarray(F), np.asarray(D)).shape
+        fracs = np.array([np.broadcast_to(v(D,T), shape) for v in self.vol_frac_funcs])
+        m = np.array([np.broadcast_to(d(T,F,D), shape) for d in self.diel_funcs])
+        m_mix = permittivity_mixture(fracs, m, self.rule)
         
-    return m_mix
+        self._cache[key] = m_mix
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last = False)
+        return m_mix
 				
 
 PERMITTITIVITY_MODELS = {}
 PERMITTITIVITY_MODELS['ice'] = lambda T,F: permittivity_ice(T,F)
 PERMITTITIVITY_MODELS['water'] = lambda T,F: permittivity_water(T,F)
-PERMITTITIVITY_MODELS['mixture'] = lambda vol_frac,m: permittivity_mixture(vol_frac,m)
\ No newline at end of file
+PERMITTITIVITY_MODELS['mixture'] = lambda vol_frac,m,rule = 'bohren_battan': permittivity_mixture(vol_frac,m,rule)
@@ -12,11 +12,44 @@ import copy
 import matplotlib.pyplot as plt
 from collections import OrderedDict
 
-from scipy.special import gamma
+from scipy.special import gamma, gammainc
 from scipy.interpolate import PchipInterpolator, interp1d
+from scipy.sparse import csr_matrix
 from  pyradsim.utilities import Lambda
 from  pyradsim.constants_cosmo import *
 
+# Trapezoidal weights of the moments, indexed by (dmin, dmax, nbins)
+_MOMENT_WEIGHTS = {}
+
+# Mass-diameter (a, b) and velocity-diameter (alpha, beta) relations of the
+# COSMO hydrometeors, used for the bulk quantities
+BULK_CONSTANTS = {'rain':(A_R,B_R,ALPHA_R,BETA_R),
+                  'snow':(A_S,B_S,ALPHA_S,BETA_S),
+                  'graupel':(A_G,B_G,ALPHA_G,BETA_G)}
+
+def get_moment_weights(dmin,dmax,nbins):
+    key = (dmin,dmax,nbins)
+    if key not in _MOMENT_WEIGHTS:
+        D = np.linspace(dmin,dmax,nbins)
+        w = np.zeros(nbins) + (D[1] - D[0])
+        w[0] *= 0.5
+        w[-1] *= 0.5
+        _MOMENT_WEIGHTS[key] = (D,w)
+    return _MOMENT_WEIGHTS[key]
+    
+def get_bulk_quantities(psd,hydrometeor = 'rain',T = None):
+    # Total concentration Nt (m^-3), water content WC (g m^-3), mass-weighted
+    # mean diameter Dm (mm) and precipitation rate R (mm h^-1 of liquid
+    # water), with one value per parameter set for PSDs with arrays
+    a, b, alpha, beta = BULK_CONSTANTS[hydrometeor]
+    M_b = psd.moment(b,T = T)
+    bulk = OrderedDict()
+    bulk['Nt'] = psd.moment(0,T = T)
+    bulk['WC'] = 1000 * a * M_b
+    bulk['Dm'] = psd.moment(b + 1,T = T) / M_b
+    bulk['R'] = 3600 * a * alpha * psd.moment(b + beta,T = T)
+    return bulk
+    
 def create_PSD(name,*args):
     if name == 'NormalizedGammaPSD':
         return NormalizedGammaPSD(*args)
@@ -44,11 +77,18 @@ class PSD(object):
     def __call__(self,*inputs):
         return self.func(*inputs)
         
-    def moment(self,order,nbins_diam = 1024):
-        dbins = np.linspace(self.dmin,self.dmax,nbins_diam)
-        dD = dbins[1] - dbins[0]
-        return np.trapz(dbins**order * self.psd_func(dbins), dx = dD)
+    def moment(self,order,nbins_diam = 1024,T = None):
+        # Moment of the given order on [dmin, dmax], with trapezoidal
+        # weights on nbins_diam regular bins (cached), T is only used by
+        # temperature dependent PSDs
+        D, w = get_moment_weights(self.dmin,self.dmax,nbins_diam)
+        return np.dot(self(D,T), w * D**order)
 
+    def get_signature(self):
+        # Everything N(D) depends on, used to detect modified PSDs
+        return (self.type,str(self.func),getattr(self.func,'scale',1),
+                getattr(self.func,'offset',0),self.dmin,self.dmax)
+        
     def get_dic(self):
         if self.type == 'BinnedPSD':
             dic = OrderedDict([('PSD type',self.type),('Bin edges',str(self.bin_edges)),
@@ -58,20 +98,21 @@ class PSD(object):
                    ('Dmin',str(self.dmin)),('Dmax',str(self.dmax))])
         return dic
     
+    # Shallow copies, only the function differs from the original PSD
     def __mul__(self,scalar):
-        obj = copy.deepcopy(self)
+        obj = copy.copy(self)
         obj.func = self.func*scalar
         return obj
     def __rdiv__(self,scalar):
-        obj = copy.deepcopy(self)
+        obj = copy.copy(self)
         obj.func = self.func/scalar
         return obj
     def __add__(self,scalar):
-        obj = copy.deepcopy(self)
+        obj = copy.copy(self)
         obj.func = self.func+scalar
         return obj
     def __sub__(self,scalar):
-        obj = copy.deepcopy(self)
+        obj = copy.copy(self)
         obj.func = self.func-scalar
         return obj
         
@@ -94,37 +135,138 @@ class PSD(object):
 Classical PSD forms
 '''
 
-class NormalizedGammaPSD(PSD):
+class ParametricPSD(PSD):
+    # PSD of a parametric family, the parameters are either scalars or 1D
+    # arrays of parameter sets (scalars are shared by all sets). With arrays,
+    # N(D) is evaluated for all sets in one broadcasted call and has the
+    # shape (n_sets, nbins)
+    def __init__(self,psd_type,params,dmin = 0,dmax = 10):
+        self.params = OrderedDict((k,np.asarray(v)) for k,v in params.items())
+        shape = np.broadcast(*self.params.values()).shape
+        if len(shape) > 1:
+            raise ValueError('Parameters of a '+psd_type+' must be scalars or 1D arrays')
+        self.n_sets = shape[0] if len(shape) else None
+        
+        if self.n_sets is None:
+            expression = self.get_expression(**dict((k,v.item()) for k,v in
+                                                    self.params.items()))
+        else:
+            # No expression for every set, this is what makes arrays cheap
+            expression = psd_type+' with '+str(self.n_sets)+' parameter sets'
+        psd_func = Lambda(self.evaluate,expression)
+        super(ParametricPSD,self).__init__(psd_type,psd_func,dmin,dmax)
+        
+    def evaluate(self,D,T):
+        params = self.params
+        if self.n_sets is not None:
+            # Parameter sets along the first dimension, diameters along the
+            # following ones
+            ndim = np.ndim(D)
+            params = OrderedDict((k,v.reshape(v.shape + (1,) * ndim) if v.ndim else v)
+                                  for k,v in params.items())
+        return self.func_params(D,T,**params)
+        
+    def get_signature(self):
+        # The expression does not contain the values of parameter arrays
+        return super(ParametricPSD,self).get_signature() + tuple((k,v.tobytes()) 
+                                              for k,v in self.params.items())
+        
+    def moment(self,order,nbins_diam = 1024,T = None):
+        # All families are of the form N0 * D**mu * exp(-Lamb * D), the
+        # moments are analytic and truncated to [dmin, dmax] with incomplete
+        # gamma functions. PSDs modified by an operator (e.g. psd * 2) are
+        # integrated numerically
+        if self.func.lambda_f != self.evaluate:
+            return super(ParametricPSD,self).moment(order,nbins_diam,T)
+        N0, mu, Lamb = self.get_gamma_params()
+        p = mu + order + 1.
+        truncation = gammainc(p,Lamb * self.dmax) - gammainc(p,Lamb * self.dmin)
+        return N0 * gamma(p) / Lamb**p * truncation
+        
+class NormalizedGammaPSD(ParametricPSD):
     def __init__(self,Nw,D0,mu,dmin = 0,dmax = 10):
-        self.type = 'NormalizedGammaPSD'
+        params = OrderedDict([('Nw',Nw),('D0',D0),('mu',mu)])
+        super(NormalizedGammaPSD,self).__init__('NormalizedGammaPSD',params,dmin,dmax)
+        
+    @staticmethod
+    def func_params(D,T,Nw,D0,mu):
+        f =  6/3.67**4 * (3.67 + mu)**(mu+4)/(gamma(mu+4))
+        Lamb = (3.67+mu)/D0
+        return Nw * f * (D/D0)**mu * np.exp(-Lamb * D)
+        
+    def get_gamma_params(self):
+        Nw, D0, mu = self.params.values()
+        f =  6/3.67**4 * (3.67 + mu)**(mu+4)/(gamma(mu+4))
+        return Nw * f / D0**mu, mu, (3.67+mu)/D0
+        
+    @staticmethod
+    def get_expression(Nw,D0,mu):
         f =  6/3.67**4 * (3.67 + mu)**(mu+4)/(gamma(mu+4))
         Lamb = (3.67+mu)/D0
-        expression = str(Nw) +' * '+str(f)+' * (D/'+str(D0)+')**'+str(mu)+' * np.exp(-'+str(Lamb)+' * D)'
-        psd_func = Lambda(lambda D, T: Nw * f * (D/D0)**mu * np.exp(-Lamb * D),expression)
-        super(NormalizedGammaPSD,self).__init__('NormalizedGammaPSD',psd_func,dmin,dmax)
+        return str(Nw) +' * '+str(f)+' * (D/'+str(D0)+')**'+str(mu)+' * np.exp(-'+str(Lamb)+' * D)'
 
-class UnnormalizedGammaPSD(PSD):
+class UnnormalizedGammaPSD(ParametricPSD):
     def __init__(self,N0,Lamb,mu,dmin,dmax):
-        self.type = 'UnnormalizedGammaPSD'
-        expression = str(N0) +' * D**'+str(mu)+' * np.exp(-'+str(Lamb)+' * D)'
-        psd_func = Lambda(lambda D, T: N0 * D**mu * np.exp(-Lamb * D),expression)
-        super(UnnormalizedGammaPSD,self).__init__('UnnormalizedGammaPSD',psd_func,dmin,dmax)
+        params = OrderedDict([('N0',N0),('Lamb',Lamb),('mu',mu)])
+        super(UnnormalizedGammaPSD,self).__init__('UnnormalizedGammaPSD',params,dmin,dmax)
+        
+    @staticmethod
+    def func_params(D,T,N0,Lamb,mu):
+        return N0 * D**mu * np.exp(-Lamb * D)
+        
+    def get_gamma_params(self):
+        return self.params['N0'], self.params['mu'], self.params['Lamb']
+        
+    @staticmethod
+    def get_expression(N0,Lamb,mu):
+        return str(N0) +' * D**'+str(mu)+' * np.exp(-'+str(Lamb)+' * D)'
 
-class ExponentialPSD(PSD):
+class ExponentialPSD(ParametricPSD):
     def __init__(self,N0,Lamb,dmin = 0,dmax = 10):
-        self.type = 'ExponentialPSD'
-
-        expression = str(N0)+' * np.exp(-'+str(Lamb)+'*D)'
-        psd_func = Lambda(lambda D, T: N0 * np.exp(-Lamb*D),expression)
+        params = OrderedDict([('N0',N0),('Lamb',Lamb)])
+        super(ExponentialPSD,self).__init__('ExponentialPSD',params,dmin,dmax)
         
-        super(ExponentialPSD,self).__init__('ExponentialPSD',psd_func,dmin,dmax)    
+    @staticmethod
+    def func_params(D,T,N0,Lamb):
+        return N0 * np.exp(-Lamb*D)
+        
+    def get_gamma_params(self):
+        return self.params['N0'], 0., self.params['Lamb']
+        
+    @staticmethod
+    def get_expression(N0,Lamb):
+        return str(N0)+' * np.exp(-'+str(Lamb)+'*D)'
 
+def get_interpolation_matrix(bin_edges,list_D,interp_method = 'linear'):
+    # Sparse matrix M such that M.dot(bin_values) is the interpolation of
+    # the bin values at the diameters list_D, either piecewise constant
+    # ('rect') or linear, and zero outside the bin edges
+    bin_edges = np.asarray(bin_edges,dtype = float)
+    list_D = np.ravel(list_D)
+    n = len(bin_edges)
+    inside = np.where(np.logical_and(list_D >= bin_edges[0], list_D <= bin_edges[-1]))[0]
+    D = list_D[inside]
+    if interp_method == 'rect':
+        idx = np.clip(np.searchsorted(bin_edges,D,side = 'right') - 1, 0, n - 1)
+        rows = inside
+        cols = idx
+        weights = np.ones(len(D))
+    else:
+        idx = np.clip(np.searchsorted(bin_edges,D,side = 'right') - 1, 0, n - 2)
+        t = (D - bin_edges[idx]) / (bin_edges[idx + 1] - bin_edges[idx])
+        rows = np.concatenate((inside, inside))
+        cols = np.concatenate((idx, idx + 1))
+        weights = np.concatenate((1 - t, t))
+    return csr_matrix((weights,(rows,cols)),shape = (len(list_D),n))
+    
 class BinnedPSD(PSD):
     def __init__(self,bin_edges,bin_values,interp_method = 'linear'):
         """ interp_method can be either : 
                   - rect
                   - linear 
                   - pchip
+            bin_values can also be a 2D array of spectra (n_sets, n_edges)
+            over the same bin edges, N(D) has then the shape (n_sets, nbins)
         """
         self.type = 'BinnedPSD'
         self.bin_edges = bin_edges
@@ -136,43 +278,103 @@ class BinnedPSD(PSD):
             warnings.warn(msg)
             warnings.warn("Using default = 'linear'")
             interp_method = 'linear'
-            
-        expression = 'Binned psd'
+        self.interp_method = interp_method
+        
+        values = np.asarray(bin_values,dtype = float)
+        self.n_sets = len(values) if values.ndim == 2 else None
+        
+        # The interpolator is built only once
         if interp_method == 'rect':
-            psd_func = Lambda(lambda D, T: interp1d(bin_edges, bin_values, kind = 'zero')(D),expression)
+            self._interpolator = interp1d(bin_edges, values, kind = 'zero', axis = -1)
         elif interp_method ==  'linear':
-            psd_func = Lambda(lambda D, T: interp1d(bin_edges, bin_values, kind = 'linear')(D),expression)
+            self._interpolator = interp1d(bin_edges, values, kind = 'linear', axis = -1)
         elif interp_method ==  'pchip':
-            psd_func = Lambda(lambda D, T: PchipInterpolator(bin_edges, bin_values)(D),expression)
+            self._interpolator = PchipInterpolator(bin_edges, values, axis = -1)
+        # Last interpolation matrix (key, matrix), for sets of spectra
+        self._matrix = None
             
+        expression = 'Binned psd'
+        psd_func = Lambda(self.evaluate,expression)
         super(BinnedPSD,self).__init__('BinnedPSD',psd_func,np.min(bin_edges),np.max(bin_edges))    
         
+    def get_signature(self):
+        return super(BinnedPSD,self).get_signature() + (self.interp_method,
+                    np.asarray(self.bin_edges,dtype = float).tobytes(),
+                    np.asarray(self.bin_values,dtype = float).tobytes())
+        
+    def evaluate(self,D,T):
+        if self.n_sets is None or self.interp_method == 'pchip':
+            return self._interpolator(D)
+        # Sets of spectra: one sparse matrix product, the matrix is reused as
+        # long as the diameters do not change
+        D = np.asarray(D,dtype = float)
+        key = D.tobytes()
+        if self._matrix is None or self._matrix[0] != key:
+            self._matrix = (key, get_interpolation_matrix(self.bin_edges,D,
+                                                          self.interp_method))
+        values = np.asarray(self.bin_values,dtype = float)
+        return self._matrix[1].dot(values.T).T.reshape((self.n_sets,) + D.shape)
+        
     
 '''
 COSMO 1-moment PSD
 '''
 
-class COSMO_1mom_graupel(PSD):
+class COSMO_1mom_graupel(ParametricPSD):
     def __init__(self,Q,dmin = 0,dmax = 10):
-        Lamb = (LAMBDA_FACTOR_G/Q)**(1./(4.+MU_G))
-        expression = str(N0_G) +' * D**'+str(MU_G)+' * np.exp(-'+str(Lamb)+' * D)'
-        psd_func = Lambda(lambda D,T: N0_G * D**MU_G * np.exp(-Lamb * D),expression)
-        super(COSMO_1mom_graupel,self).__init__('COSMO_1mom_graupel',psd_func,dmin,dmax)
+        params = OrderedDict([('Lamb',(LAMBDA_FACTOR_G/np.asarray(Q))**(1./(4.+MU_G)))])
+        super(COSMO_1mom_graupel,self).__init__('COSMO_1mom_graupel',params,dmin,dmax)
+        
+    @staticmethod
+    def func_params(D,T,Lamb):
+        return N0_G * D**MU_G * np.exp(-Lamb * D)
+        
+    def get_gamma_params(self):
+        return N0_G, MU_G, self.params['Lamb']
+        
+    @staticmethod
+    def get_expression(Lamb):
+        return str(N0_G) +' * D**'+str(MU_G)+' * np.exp(-'+str(Lamb)+' * D)'
 
-class COSMO_1mom_rain(PSD):
+class COSMO_1mom_rain(ParametricPSD):
     def __init__(self,Q,dmin = 0,dmax = 10):
-        Lamb = (LAMBDA_FACTOR_R/Q)**(1./(4.+MU_R))
-        expression = str(N0_R) +' * D**'+str(MU_R)+' * np.exp(-'+str(Lamb)+' * D)'
-        psd_func = Lambda(lambda D,T: N0_R * D**MU_R * np.exp(-Lamb * D),expression)
-        super(COSMO_1mom_rain,self).__init__('COSMO_1mom_rain',psd_func,dmin,dmax)
+        params = OrderedDict([('Lamb',(LAMBDA_FACTOR_R/np.asarray(Q))**(1./(4.+MU_R)))])
+        super(COSMO_1mom_rain,self).__init__('COSMO_1mom_rain',params,dmin,dmax)
+        
+    @staticmethod
+    def func_params(D,T,Lamb):
+        return N0_R * D**MU_R * np.exp(-Lamb * D)
+        
+    def get_gamma_params(self):
+        return N0_R, MU_R, self.params['Lamb']
+        
+    @staticmethod
+    def get_expression(Lamb):
+        return str(N0_R) +' * D**'+str(MU_R)+' * np.exp(-'+str(Lamb)+' * D)'
 
-class COSMO_1mom_snow(PSD):
+def get_N0_snow(T):
+    # Temperature dependent intercept of the snow PSD, mm^-1 m^-3
+    return 13.5*(5.65*10**5*np.exp(-0.107*(T-273.15)))/1000
+    
+class COSMO_1mom_snow(ParametricPSD):
+    # The intercept and slope depend on the temperature given here, not on
+    # the temperature at evaluation
     def __init__(self,Q,T,dmin = 0,dmax = 10):
-        N0_S = lambda T: 13.5*(5.65*10**5*np.exp(-0.107*(T-273.15)))/1000 # mm^-1 m^-3
-        Lamb = (LAMBDA_FACTOR_R/Q)**(1./(4.+MU_R))
-        expression = str(N0_S(T)) +' * D**'+str(MU_S)+' * np.exp(-'+str(Lamb)+' * D)'
-        psd_func = Lambda(lambda D,T: N0_S(T) * D**MU_S * np.exp(-Lamb * D),expression)
-        super(COSMO_1mom_snow,self).__init__('COSMO_1mom_rain',psd_func,dmin,dmax)
+        N0 = get_N0_snow(np.asarray(T))
+        Lamb = (A_S*N0*LAMBDA_FACTOR_S/np.asarray(Q))**(1./(B_S+1.+MU_S))
+        params = OrderedDict([('N0',N0),('Lamb',Lamb)])
+        super(COSMO_1mom_snow,self).__init__('COSMO_1mom_snow',params,dmin,dmax)
+        
+    @staticmethod
+    def func_params(D,T,N0,Lamb):
+        return N0 * D**MU_S * np.exp(-Lamb * D)
+        
+    def get_gamma_params(self):
+        return self.params['N0'], MU_S, self.params['Lamb']
+        
+    @staticmethod
+    def get_expression(N0,Lamb):
+        return str(N0) +' * D**'+str(MU_S)+' * np.exp(-'+str(Lamb)+' * D)'
         
 if __name__ == '__main__':
     a = create_PSD('ExponentialPSD',1,1)
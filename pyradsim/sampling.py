@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Jun 22 11:37:15 2016
+
+@author: wolfensb
+"""
+
+import warnings
+import numpy as np
+
+try:
+    from scipy.stats import qmc
+except ImportError: # Old scipy, no quasi-random sequences
+    qmc = None
+
+def latin_hypercube(n, bounds, seed = None):
+    # n samples of a Latin hypercube design, bounds is an array (k, 2) with
+    # the min. and max. of every parameter, returns an array (n, k)
+    bounds = np.asarray(bounds, dtype = float)
+    k = len(bounds)
+    rng = np.random.RandomState(seed)
+    # One sample in every of the n strata of every parameter
+    u = (np.argsort(rng.rand(n, k), axis = 0) + rng.rand(n, k)) / n
+    return bounds[:,0] + u * (bounds[:,1] - bounds[:,0])
+
+def get_unit_samples(n, d, seed = None):
+    # n samples in the unit hypercube of dimension d, from a scrambled Sobol
+    # sequence if available, random otherwise
+    if qmc is None:
+        warnings.warn('scipy.stats.qmc is not available, using random samples')
+        return np.random.RandomState(seed).rand(n, d)
+    with warnings.catch_warnings():
+        # Sobol sequences are balanced for powers of 2 only
+        warnings.simplefilter('ignore')
+        return qmc.Sobol(d, seed = seed).random(n)
+
+def saltelli_design(n, bounds, seed = None):
+    # Saltelli design with n base samples: matrices A, B and the k matrices
+    # AB_i (A with the column i of B), stacked in this order, returns an
+    # array (n * (k + 2), k)
+    bounds = np.asarray(bounds, dtype = float)
+    k = len(bounds)
+    u = get_unit_samples(n, 2 * k, seed)
+    A = u[:,:k]
+    B = u[:,k:]
+    AB = []
+    for i in range(k):
+        AB_i = A.copy()
+        AB_i[:,i] = B[:,i]
+        AB.append(AB_i)
+    u = np.concatenate([A, B] + AB)
+    return bounds[:,0] + u * (bounds[:,1] - bounds[:,0])
+
+def get_saltelli_indices(y, k):
+    # First order (Saltelli, 2010) and total (Jansen, 1999) sensitivity
+    # indices of the k parameters from the outputs y of a Saltelli design,
+    # the samples are along the first dimension of y and the indices have
+    # the shape (k, other dimensions of y)
+    y = np.asarray(y, dtype = float)
+    n = len(y) // (k + 2)
+    y_A = y[:n]
+    y_B = y[n:2 * n]
+    var = np.var(np.concatenate((y_A, y_B)), axis = 0)
+    var = np.where(var > 0, var, np.nan) # Constant outputs have no indices
+    S1 = np.zeros((k,) + y.shape[1:]) + np.nan
+    ST = np.zeros((k,) + y.shape[1:]) + np.nan
+    for i in range(k):
+        y_AB = y[(2 + i) * n:(3 + i) * n]
+        S1[i] = np.mean(y_B * (y_AB - y_A), axis = 0) / var
+        ST[i] = 0.5 * np.mean((y_A - y_AB)**2, axis = 0) / var
+    return S1, ST
+
+def get_binned_indices(samples, y):
+    # First order sensitivity indices Var(E[y|x_i]) / Var(y) of any design
+    # (e.g. Latin hypercube), E[y|x_i] is estimated on sqrt(n) bins with the
+    # same number of samples. Total indices are not available (NaN). The 
+    # samples are along the first dimension of y, see get_saltelli_indices
+    samples = np.asarray(samples, dtype = float)
+    y = np.asarray(y, dtype = float)
+    n, k = samples.shape
+    var = np.var(y, axis = 0)
+    var = np.where(var > 0, var, np.nan)
+    S1 = np.zeros((k,) + y.shape[1:]) + np.nan
+    ST = np.zeros((k,) + y.shape[1:]) + np.nan
+    n_bins = max(int(np.sqrt(n)), 1)
+    for i in range(k):
+        bins = np.array_split(np.argsort(samples[:,i]), n_bins)
+        means = np.array([np.mean(y[b], axis = 0) for b in bins])
+        sizes = np.array([len(b) for b in bins]).reshape((-1,) + (1,) * (y.ndim - 1))
+        S1[i] = np.sum(sizes * (means - np.mean(y, axis = 0))**2, axis = 0) / n / var
+    return S1, ST
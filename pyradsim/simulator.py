@@ -9,6 +9,10 @@ import numpy as np
 import copy
 import itertools
 import numbers
+import os
+import uuid
+import multiprocessing as mp
+from collections import OrderedDict
 # These tags will be read separately, their arguments needs to be specified 
 # in brackets after the yaml input for example
 
@@ -18,9 +22,15 @@ import numbers
 VALID_TAGS = ['%sens']
 
 from pyradsim.parse import parse
-from pyradsim.box import Box
+from pyradsim.box import Box, add_dimensions, get_dirty_stages
+from pyradsim.hydrometeor import get_pol_var_frequency
 from pyradsim.tmatrix import compute_pol_var
-from pyradsim.utilities import set_from_dict, get_from_dict,InfoArray
+from pyradsim.cache import create_cache
+from pyradsim.lut import load_luts
+from pyradsim.executor import create_executor
+from pyradsim.utilities import get_from_dict, InfoArray, ConfigOverlay
+from pyradsim.sampling import latin_hypercube, saltelli_design
+from pyradsim.sampling import get_binned_indices, get_saltelli_indices
 
 class Simulator(object):    
     def __new__(self,box_file, config_file):
@@ -37,26 +47,109 @@ class SingleSimulator(object):
         self.config = config
         self.boxes = []
         
+        # On-disk cache of scattering matrices, shared by all hydrometeors
+        self.cache = create_cache(config)
+        # Precomputed scattering lookup tables
+        self.luts = load_luts(config)
+        # Pool of workers for T-matrix computations, shared by all hydrometeors
+        self.executor = create_executor(config)
+        
         self._boxes_dic = boxes
         # Create list of all boxes
         for k in boxes.keys():
-            self.boxes.append(Box(k,boxes[k],self.config))
+            self.boxes.append(Box(k,boxes[k],self.config,self.cache,self.luts,
+                                  self.executor))
+            
+        # Scatterers that the workers build once at startup
+        self.executor.scatterer_params = list(set([p for b in self.boxes for h in b.hydrometeors
+                                                   for p in h.get_all_scatterer_params()]))
+        
+    def close(self):
+        # Shuts down the pool of workers
+        self.executor.close()
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *args):
+        self.close()
             
     # Getter and setters for the dictionary that contains all params from the YAML
     @property
     def boxes_dic(self):
-        return copy.deepcopy(self._boxes_dic)
+        # Not copied, must not be modified: use a ConfigOverlay to change
+        # values
+        return self._boxes_dic
     @boxes_dic.setter
     def boxes_dic(self,dic):
         self._boxes_dic = dic
         self.update()
         
-    def update(self):
-        # TODO proper check
+    def set_boxes_dic(self,dic,dirty_keys = None):
+        # Assigns a new dictionary of boxes of which only the values at the
+        # key paths dirty_keys (e.g. ['box_1','hydrometeors','rain','psd'])
+        # differ from the current one, None if anything may differ
+        self._boxes_dic = dic
+        self.update(dirty_keys)
+        
+    def update(self,dirty_keys = None):
+        # Boxes without modified keys keep all their outputs, the other ones
+        # only recompute the stages that depend on the modified keys
         for k,box in enumerate(self._boxes_dic):
-            self.boxes[k].update(self._boxes_dic[box],self.config)
+            if dirty_keys is None:
+                self.boxes[k].update(self._boxes_dic[box],self.config)
+            else:
+                dirty = [key[1:] for key in dirty_keys if key[0] == box]
+                if len(dirty):
+                    self.boxes[k].update(self._boxes_dic[box],self.config,dirty)
             
+    def compute_scattering(self):
+        # Computes the scattering matrices of every unique scatter signature
+        # only once, hydrometeors with the same signature share the arrays
+        groups = OrderedDict()
+        for box in self.boxes:
+            for h in box.hydrometeors:
+                if h.integration.get('method','trapz') != 'trapz':
+                    continue # Scattering is computed on the quadrature nodes
+                groups.setdefault(h.get_scatter_signature(),[]).append(h)
+                
+        n_hydrom = sum([len(g) for g in groups.values()])
+        print('Computing scattering of '+str(n_hydrom)+' hydrometeors ('+
+              str(len(groups))+' unique scatter signatures)')
+        
+        refs = []
+        jobs = []
+        for hydrometeors in groups.values():
+            # Use an up-to-date hydrometeor as reference if there is one
+            ref = hydrometeors[0]
+            for h in hydrometeors:
+                if not h.is_scatter_outdated():
+                    ref = h
+                    break
+            refs.append(ref)
+            # The master grid must cover the PSD ranges of all hydrometeors
+            dmin = min([h.psd.dmin for h in hydrometeors])
+            dmax = max([h.psd.dmax for h in hydrometeors])
+            job = ref.get_SZ_job(dmin, dmax)
+            if job is not None:
+                jobs.append((ref, job) + ref.get_SZ_tasks(job[1]))
+                
+        # The T-matrix tasks of all hydrometeors and frequencies are sent to
+        # the workers in one batch
+        results = self.executor.compute_SZ_batches([(tasks, np.shape(ref.theta)) 
+                                                    for ref, job, S, Z, tasks, tasks_idx in jobs])
+        for (ref, job, S, Z, tasks, tasks_idx), (S_tm, Z_tm) in zip(jobs, results):
+            ref.set_SZ_job(job, *ref.set_SZ_tasks(S, Z, tasks_idx, S_tm, Z_tm))
+            
+        for ref, hydrometeors in zip(refs, groups.values()):
+            S, Z = ref.get_SZ()
+            for h in hydrometeors:
+                if h is not ref:
+                    h.set_SZ(S, Z, ref.list_D, ref._grid_step)
+                    
     def get_pol_vars(self):
+        self.compute_scattering()
+        
         boxes_pol_vars = {}
         for box in self.boxes:
             print('Simulating scattering of box: '+box.name)
@@ -64,46 +157,70 @@ class SingleSimulator(object):
             box_pol_vars = box.get_pol_vars()
             boxes_pol_vars[box.name] = box_pol_vars
         
+        if self.cache is not None:
+            print(self.cache)
         return boxes_pol_vars
         
             
     def get_integrated_pol_vars(self):
-        ensemble_S = np.zeros((4,),dtype=complex) # Amplitutde matrix
-        ensemble_Z = np.zeros((16,)) # Phase matrix
-        
-        # Check if radar frequency is the same in every box
-        all_freq = [b.radar['frequency'] for b in self.boxes]  
-        
-        if len(np.unique(all_freq)) != 1:
-            print('Integration of polarimetric variables over multiple boxes',
-                  'is only possible when the radar frequency is the same in every box')
-            print('Would you like to use the frequency of the first box ('+str(self.boxes[0].radar['frequency'])+' GHz) for all boxes?')
-            userInput = input("[Y/N]")
-            if userInput == 'Y':
-                freq = self.boxes[0].radar['frequency']
-            elif userInput == 'N':
-                while True:
-                  try:
-                     userInput = float(input('Please specify the frequency to use for all boxes (in GHz):'))       
-                  except ValueError:
-                     print("Not a number!")
-                     continue
-                  else:
-                     break 
-
-                freq = float(userInput)
-        else:
-            freq = all_freq[0]
-            
+        self.check_integration()
+        self.compute_scattering()
+        
+        boxes_SZ = []
         for box in self.boxes:
             print('Simulating scattering of box: '+box.name)
             # Compute scattering matrices
-            box_S, box_Z = box.get_ensemble_SZ()
-
-            ensemble_S += box_S
-            ensemble_Z += box_Z
+            boxes_SZ.append(box.get_ensemble_SZ())
+            
+        if self.cache is not None:
+            print(self.cache)
+        return self.integrate_boxes(boxes_SZ)
+        
+    def check_integration(self):
+        # Check if the elevation angles are the same in every box
+        all_elev = [np.atleast_1d(b.geometry['elevation_angle']).tolist() for b in self.boxes]
+        if any([e != all_elev[0] for e in all_elev]):
+            raise ValueError('Integration of polarimetric variables over multiple boxes '+
+                             'is only possible when the elevation angles are the same in every box')
+        all_freq = sorted(set([f for b in self.boxes for f in np.atleast_1d(b.frequency)]))
+        for f in all_freq:
+            missing = [b.name for b in self.boxes if f not in np.atleast_1d(b.frequency)]
+            if len(missing):
+                print('Warning: boxes '+', '.join(missing)+' are not simulated at '+
+                      str(f)+' GHz and are ignored in the integration at this frequency')
+                      
+    def integrate_boxes(self, boxes_SZ):
+        # Polarimetric variables of the sum of the ensemble matrices of all
+        # boxes (list of (S, Z) in the order of self.boxes). Integration is 
+        # done separately for every frequency, over all boxes simulated at
+        # this frequency. The matrices can have leading dimensions, e.g. the
+        # points of a sensitivity analysis
+        elevation_angle = self.boxes[0].geometry['elevation_angle']
+        all_freq = sorted(set([f for b in self.boxes for f in np.atleast_1d(b.frequency)]))
+        
+        box_shape = np.shape(self.boxes[0].frequency) + np.shape(elevation_angle)
+        lead = np.shape(boxes_SZ[0][0])[:-1-len(box_shape)]
+        lead_idx = (slice(None),) * len(lead)
+        
+        shape = lead + (len(all_freq),) + np.shape(elevation_angle)
+        ensemble_S = np.zeros(shape + (4,),dtype=complex) # Amplitutde matrix
+        ensemble_Z = np.zeros(shape + (16,)) # Phase matrix
+        for box, (box_S, box_Z) in zip(self.boxes, boxes_SZ):
+            box_freq = np.atleast_1d(box.frequency)
+            box_S = box_S.reshape(lead + (len(box_freq),) + shape[len(lead)+1:] + (4,))
+            box_Z = box_Z.reshape(lead + (len(box_freq),) + shape[len(lead)+1:] + (16,))
+            for i,f in enumerate(box_freq):
+                ensemble_S[lead_idx + (all_freq.index(f),)] += box_S[lead_idx + (i,)]
+                ensemble_Z[lead_idx + (all_freq.index(f),)] += box_Z[lead_idx + (i,)]
             
-        return compute_pol_var(ensemble_S,ensemble_Z,freq)
+        if len(all_freq) == 1:
+            freq = all_freq[0]
+            ensemble_S = ensemble_S[lead_idx + (0,)]
+            ensemble_Z = ensemble_Z[lead_idx + (0,)]
+        else:
+            freq = all_freq
+        pol = compute_pol_var(ensemble_S,ensemble_Z,get_pol_var_frequency(freq,elevation_angle))
+        return add_dimensions(pol, freq, elevation_angle)
         
     def __str__(self):
         msg = ''
@@ -112,10 +229,297 @@ class SingleSimulator(object):
             
         return msg
         
+# Simulators of the current process for the points of the sensitivity
+# analysis, indexed by the token of the run
+_SENS_SIMULATORS = {}
+
+def _simulate_sens_point(task):
+    # task = (token, initial boxes, config, keys, index, factors, integrated),
+    # every worker builds its simulator once per run and then only updates it
+    token, boxes, config, keys, i, factors, integrated = task
+    if token not in _SENS_SIMULATORS:
+        _SENS_SIMULATORS.clear()
+        _SENS_SIMULATORS[token] = SingleSimulator(boxes, config)
+    simulator = _SENS_SIMULATORS[token]
+    
+    simulator.set_boxes_dic(get_sens_overlay(boxes,keys,factors),keys)
+    
+    if integrated:
+        return i, simulator.get_integrated_pol_vars()
+    return i, simulator.get_pol_vars()
+
+def map_sens_items(dic, integrated, func):
+    # Applies func to all polarimetric variables of a dictionary, per box 
+    # or integrated, and returns a dictionary with the same structure
+    if integrated:
+        return OrderedDict((k,func(dic[k])) for k in dic.keys())
+    return OrderedDict((b,OrderedDict((k,func(dic[b][k])) for k in dic[b].keys()))
+                       for b in dic.keys())
+                       
+def get_sens_overlay(boxes, keys, factors):
+    # View of the boxes where the values at the key paths are multiplied by
+    # the factors, without copying the boxes
+    overrides = dict((tuple(key),get_from_dict(boxes,key)*factor) 
+                     for key,factor in zip(keys,factors))
+    return ConfigOverlay(boxes,overrides)
+    
+def create_sens_arrays(reference, integrated, dimensions, names, values):
+    # Arrays (NaN) of the results of a sensitivity analysis, with the same
+    # structure as the polarimetric variables of the reference. The 
+    # dimensions of the parameters (names, values) are followed by the ones
+    # of the variables (e.g. frequency, elevation angle)
+    def create(pol):
+        attributes = getattr(pol,'attributes',{})
+        return OrderedDict((k,InfoArray(np.zeros(tuple(dimensions) + np.shape(pol[k])) + np.nan,
+                                        list(names) + list(attributes.keys()),
+                                        list(values) + list(attributes.values())))
+                           for k in pol.keys())
+    if integrated:
+        return create(reference)
+    return OrderedDict((b,create(reference[b])) for b in reference.keys())
+    
+def get_sens_items(dic, integrated):
+    # List of (name, value) of a dictionary of polarimetric variables, per
+    # box ('box/variable') or integrated ('variable')
+    if integrated:
+        return [(k,dic[k]) for k in dic.keys()]
+    return [(b+'/'+k,dic[b][k]) for b in dic.keys() for k in dic[b].keys()]
+    
+def create_sens_executor(config):
+    # Pool of processes for the points of the sensitivity analysis, None to
+    # simulate them in the current process
+    processes = config.get('sens_processes',1)
+    if processes == 1:
+        return None
+    return mp.Pool(processes = processes or mp.cpu_count())
+
+def save_sens_checkpoint(filename, items, sens_params_values, done):
+    # Saves the partial results of a sensitivity analysis, the file is
+    # replaced atomically
+    arrays = dict(('var_'+k,np.asarray(v)) for k,v in items.items())
+    for j,v in enumerate(sens_params_values):
+        arrays['param_'+str(j)] = v
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename,'wb') as f:
+        np.savez(f,done = done,**arrays)
+    os.replace(tmp_filename,filename)
+    
+def load_sens_checkpoint(filename, items, sens_params_values):
+    # Reads the partial results of a sensitivity analysis in the arrays of
+    # items and returns the mask of the points already simulated
+    data = np.load(filename)
+    for j,v in enumerate(sens_params_values):
+        if not np.array_equal(data['param_'+str(j)],v):
+            raise ValueError('Checkpoint '+filename+' was written for other '+
+                             'parameter values, remove it to start again')
+    for k in items.keys():
+        items[k][...] = data['var_'+k]
+    return data['done']
+    
+def load_sens_samples(filename, design):
+    # Samples of a sampling sensitivity analysis (lhs, sobol) saved in a
+    # checkpoint, None if the checkpoint was written for another design
+    data = np.load(filename)
+    for j,v in enumerate(design):
+        name = 'param_'+str(j + 1)
+        if name not in data.files or not np.array_equal(data[name],v):
+            return None
+    return data['param_0']
+    
 class SensSimulator(SingleSimulator): # For sensitivity analysis
     def __init__(self,boxes, config, tags):
         self.sens_params = tags['%sens']
         super(SensSimulator,self).__init__(boxes,config)
+        # Executor of the points of the analysis, any object with a map (or
+        # imap_unordered) method can be assigned instead, e.g. the client of
+        # a cluster. By default the pool of processes is started at the first
+        # analysis
+        self.sens_executor = None
+        
+    def _get_sens_executor(self):
+        if self.sens_executor is None:
+            self.sens_executor = create_sens_executor(self.config)
+        return self.sens_executor
+        
+    def close(self):
+        if self.sens_executor is not None and hasattr(self.sens_executor,'close'):
+            self.sens_executor.close()
+            self.sens_executor.join()
+            self.sens_executor = None
+        super(SensSimulator,self).close()
+        
+    def _run_sens_grid(self, initial_box_config, sens_params_values, dic_sens, integrated):
+        # Simulates all combinations of the parameter values and writes the
+        # results in the arrays of dic_sens at their position in the grid
+        dimensions = tuple([len(v) for v in sens_params_values])
+        combinations = list(itertools.product(*sens_params_values))
+        self._run_sens_points(initial_box_config,combinations,dimensions,dic_sens,
+                              integrated,sens_params_values)
+        
+    def _run_sens_sampling(self, initial_box_config, reference, integrated):
+        # Latin hypercube ('lhs') or Saltelli ('sobol') design of sens_samples
+        # samples of the factors in the ranges of the tags. Returns the
+        # samples, the outputs for every sample and the first order (S1) and
+        # total (ST) variance-based sensitivity indices of every parameter
+        names = ['/'.join(p) for p in self.sens_params[0]]
+        bounds = np.array([p[0:2] for p in self.sens_params[1]],dtype = float)
+        n = int(self.config.get('sens_samples',64))
+        seed = self.config.get('sens_seed')
+        # Design of the samples, stored in the checkpoint with the samples
+        design = [bounds,np.array([self.config['sens_analysis'],str(n)])]
+        
+        samples = None
+        checkpoint = self.config.get('sens_checkpoint')
+        if checkpoint is not None and os.path.exists(checkpoint):
+            # Resume with the samples of the checkpoint, without sens_seed 
+            # new samples would differ
+            samples = load_sens_samples(checkpoint,design)
+        if samples is not None:
+            pass
+        elif self.config['sens_analysis'] == 'lhs':
+            samples = latin_hypercube(n,bounds,seed)
+        else:
+            # n * (nb of parameters + 2) simulations
+            samples = saltelli_design(n,bounds,seed)
+        print('Simulating '+str(len(samples))+' samples')
+        
+        sample_idx = np.arange(len(samples))
+        outputs = create_sens_arrays(reference,integrated,(len(samples),),['sample'],
+                                     [sample_idx])
+        self._run_sens_points(initial_box_config,[tuple(x) for x in samples],
+                              (len(samples),),outputs,integrated,[samples] + design)
+        
+        def get_indices(y):
+            # Indices along the samples, the other dimensions of the outputs
+            # (e.g. frequency, elevation angle) are kept
+            if self.config['sens_analysis'] == 'lhs':
+                S1, ST = get_binned_indices(samples,y)
+            else:
+                S1, ST = get_saltelli_indices(y,len(names))
+            dims = list(y.attributes.keys())[1:]
+            values = [y.attributes[d] for d in dims]
+            return (InfoArray(S1,['parameter'] + dims,[names] + values),
+                    InfoArray(ST,['parameter'] + dims,[names] + values))
+        indices = map_sens_items(outputs,integrated,get_indices)
+        
+        dic_sens = OrderedDict()
+        dic_sens['samples'] = InfoArray(samples,['sample','parameter'],[sample_idx,names])
+        dic_sens['outputs'] = outputs
+        dic_sens['S1'] = map_sens_items(indices,integrated,lambda v: v[0])
+        dic_sens['ST'] = map_sens_items(indices,integrated,lambda v: v[1])
+        return dic_sens
+        
+    def _run_sens_points(self, initial_box_config, combinations, dimensions, dic_sens,
+                         integrated, sens_params_values):
+        # Simulates the points (factors of every parameter) and writes the
+        # results in the arrays of dic_sens (of shape dimensions) at the 
+        # position of the point. With a 'sens_checkpoint' file in the
+        # configuration, the results are saved after every point and the
+        # points already done are skipped
+        items = OrderedDict(get_sens_items(dic_sens,integrated))
+        
+        checkpoint = self.config.get('sens_checkpoint')
+        done = np.zeros(dimensions,dtype = bool)
+        if checkpoint is not None and os.path.exists(checkpoint):
+            done = load_sens_checkpoint(checkpoint,items,sens_params_values)
+            print('Resuming sensitivity analysis, '+str(int(np.sum(done)))+'/'+
+                  str(len(combinations))+' points already simulated')
+        
+        todo = [i for i in range(len(combinations)) 
+                if not done[np.unravel_index(i,dimensions)]]
+        
+        def store(i, pol_vars, save = True):
+            # Get n-D index from 1D index 
+            pos_in_array = np.unravel_index(i,dimensions)
+            for k,v in get_sens_items(pol_vars,integrated):
+                items[k][pos_in_array] = v
+            done[pos_in_array] = True
+            print('Point '+str(int(np.sum(done)))+'/'+str(len(combinations))+
+                  ' simulated: '+str(combinations[i]))
+            if checkpoint is not None and save:
+                save_sens_checkpoint(checkpoint,items,sens_params_values,done)
+                
+        if len(todo) and self.is_psd_analysis():
+            # Same scattering for all points, the PSDs of all points are 
+            # integrated at once in the current process
+            all_pol_vars = self._simulate_psd_points(initial_box_config,
+                                                     [combinations[i] for i in todo],
+                                                     integrated)
+            for i, pol_vars in zip(todo, all_pol_vars):
+                store(i,pol_vars,save = False)
+            if checkpoint is not None:
+                save_sens_checkpoint(checkpoint,items,sens_params_values,done)
+            return
+            
+        sens_executor = self._get_sens_executor() if len(todo) else None
+        if sens_executor is None:
+            for i in todo:
+                # Assign the perturbed view of the boxes to current simulator
+                self.set_boxes_dic(get_sens_overlay(initial_box_config,self.sens_params[0],
+                                                    combinations[i]),self.sens_params[0])
+                if integrated:
+                    store(i,super(SensSimulator,self).get_integrated_pol_vars())
+                else:
+                    store(i,super(SensSimulator,self).get_pol_vars())
+            self.set_boxes_dic(initial_box_config,self.sens_params[0])
+        else:
+            # The workers compute the T-matrix in their own process
+            config = copy.deepcopy(self.config)
+            config['processes'] = 1
+            token = uuid.uuid4().hex
+            tasks = [(token,initial_box_config,config,self.sens_params[0],i,
+                      combinations[i],integrated) for i in todo]
+            run = getattr(sens_executor,'imap_unordered',sens_executor.map)
+            for i, pol_vars in run(_simulate_sens_point,tasks):
+                store(i,pol_vars)
+        
+
+    def is_psd_analysis(self):
+        # True if the parameters only modify the integration of hydrometeors
+        # (e.g. their PSD, see box.STAGES) integrated with the trapezoidal
+        # rule, the scattering is then the same for all points
+        for key in self.sens_params[0]:
+            if get_dirty_stages(key[1:])[:1] != ['integration'] or key[1] != 'hydrometeors':
+                return False
+            box = self.boxes[list(self._boxes_dic.keys()).index(key[0])]
+            for h in box.hydrometeors:
+                if h.name == key[2] and h.integration.get('method','trapz') != 'trapz':
+                    return False
+        return True
+        
+    def _simulate_psd_points(self, initial_box_config, points, integrated):
+        # Polarimetric variables of the points of an analysis which only 
+        # modifies PSDs (see is_psd_analysis), every hydrometeor integrates
+        # the PSDs of all points with one matrix product. Returns the list of
+        # the outputs of every point
+        keys = self.sens_params[0]
+        self.set_boxes_dic(initial_box_config,keys)
+        if integrated:
+            self.check_integration()
+        self.compute_scattering()
+        print('Integrating '+str(len(points))+' points at once')
+        
+        overlays = [get_sens_overlay(initial_box_config,keys,p) for p in points]
+        boxes_SZ = []
+        boxes_pol_vars = OrderedDict()
+        for box in self.boxes:
+            names = set([key[2] for key in keys if key[0] == box.name])
+            psds = dict((h,[o[box.name]['hydrometeors'][h]['psd'] for o in overlays])
+                        for h in names)
+            S, Z = box.get_ensemble_SZ_batch(len(points),psds)
+            if integrated:
+                boxes_SZ.append((S, Z))
+            else:
+                elevation_angle = box.geometry['elevation_angle']
+                boxes_pol_vars[box.name] = compute_pol_var(S,Z,get_pol_var_frequency(
+                                                           box.frequency,elevation_angle))
+                                                           
+        if integrated:
+            pol = self.integrate_boxes(boxes_SZ)
+            return [OrderedDict((k,pol[k][j]) for k in pol.keys()) 
+                    for j in range(len(points))]
+        return [OrderedDict((b,OrderedDict((k,pol[k][j]) for k in pol.keys()))
+                            for b,pol in boxes_pol_vars.items()) for j in range(len(points))]
         
     def get_pol_vars(self):
         print('Estimation of polarimetric variables with sensitivty analysis')
@@ -130,10 +534,6 @@ class SensSimulator(SingleSimulator): # For sensitivity analysis
         print('Computing reference')
         reference = super(SensSimulator,self).get_pol_vars()
         
-        # Get keys of reference (i.e. pol variable names)
-        boxes_names_ref = list(reference.keys())       
-        key_names_ref = list(reference[boxes_names_ref[0]].keys())
-        
         if type_sens_analysis == 'serial':
             dic_sens = {}
             for key,param in zip(self.sens_params[0],self.sens_params[1]):
@@ -141,49 +541,34 @@ class SensSimulator(SingleSimulator): # For sensitivity analysis
                 key_str = '/'.join(key)
                 dic_sens[key_str] = {}
                 print('Sensitivity analysis on param:'+str(key))
-                working_copy = copy.deepcopy(initial_box_config)
                 
                 n_pts = int(param[2])
                 range_var = np.linspace(param[0],param[1],n_pts)/100
                 current_val = get_from_dict(initial_box_config,key)
                 
-                sens_values = []
                 sens_param_name = key_str.split('/')[-1]
-                if not isinstance(current_val, numbers.Number):
+                if isinstance(current_val, numbers.Number):
+                    sens_values = range_var * current_val
+                else:
                     sens_param_name += ' factor'
+                    sens_values = range_var
+                dic_sens[key_str] = create_sens_arrays(reference,False,(n_pts,),
+                                                       [sens_param_name],[sens_values])
                     
                 for i,r in enumerate(range_var):
                     print('Step '+str(i+1)+'/'+str(len(range_var)))
-                    if isinstance(current_val, numbers.Number):
-                        sens_values.append(r * current_val)
-                    else:
-                        sens_values.append(r)
-                        
-                    # Modify working copy of boxes dict and assign it to current
-                    # simulator
-                    set_from_dict(working_copy ,key,current_val*r)
-                    self.boxes_dic = working_copy
+                    # Assign a view of the boxes with the modified value to
+                    # current simulator
+                    working_copy = ConfigOverlay(initial_box_config,{tuple(key):current_val*r})
+                    self.set_boxes_dic(working_copy,self.sens_params[0])
                                         
                     # Simulate polarimetric variables
                     pol_vars = super(SensSimulator,self).get_pol_vars()
-                    
                     for b in pol_vars.keys():
-                        if b not in dic_sens[key_str].keys():
-                            dic_sens[key_str][b] = {}
-                            for k in pol_vars[b].keys():
-                                dic_sens[key_str][b][k] = []
-
-                    for b in pol_vars.keys():
-                        for k in dic_sens[key_str][b].keys():
-                            dic_sens[key_str][b][k].append(pol_vars[b][k])
-                            
-                # Convert lists to InfoArray
-                for b in dic_sens[key_str].keys():
-                    for k in dic_sens[key_str][b].keys():
-                        dic_sens[key_str][b][k] = InfoArray(dic_sens[key_str][b][k],
-                                        [sens_param_name],[sens_values])
+                        for k in pol_vars[b].keys():
+                            dic_sens[key_str][b][k][i] = pol_vars[b][k]
                                         
-        elif type_sens_analysis == 'parallel': # ==> This will be very time-consuming
+        elif type_sens_analysis == 'parallel':
             dic_sens = {}
             # Generate all sequences of values
             dimensions = np.array([p[2] for p in self.sens_params[1]],dtype = int)
@@ -191,41 +576,17 @@ class SensSimulator(SingleSimulator): # For sensitivity analysis
             
         
             sens_params_names = ['/'.join(p) for p in self.sens_params[0]]
-            sens_params_values = [np.linspace(p[0],p[1],p[2]) for p in self.sens_params[1]]  
+            sens_params_values = [np.linspace(p[0],p[1],int(p[2])) for p in self.sens_params[1]]  
             
-            dic_sens = {}
-                   
-            for b in boxes_names_ref:
-                dic_sens[b] = {}
-                for k in key_names_ref:
-                    dic_sens[b][k] = InfoArray(np.zeros(dimensions)+np.nan,
-                                  sens_params_names,sens_params_values)
+            dic_sens = create_sens_arrays(reference,False,dimensions,sens_params_names,
+                                          sens_params_values)
     
-            # Generate possible combinations of parameter values
-            combinations = list(itertools.product(*sens_params_values))
-            
-            
-            for i,c in enumerate(combinations):
-                # Get n-D index from 1D index 
-                pos_in_array = np.unravel_index(i,dimensions)
-                
-                working_copy = copy.deepcopy(initial_box_config)
-                print('Step '+str(i+1)+'/'+str(len(combinations)))
-                print('Simulating point ',str(sens_params_names),' = ',str(c))
-                # Modify working copy of boxes dict and assign it to current
-                # simulator
-                for j,key in enumerate(self.sens_params[0]):
-                    current_val = get_from_dict(initial_box_config,key)
-                    set_from_dict(working_copy,key,current_val*c[j])
-                    
-                self.boxes_dic = working_copy
-                              
-                # Simulate polarimetric variables
-                pol_vars = super(SensSimulator,self).get_pol_vars()
-
-                for b in pol_vars.keys():
-                    for k in pol_vars[b].keys():
-                        dic_sens[b][k][pos_in_array] = pol_vars[b][k]
+            self._run_sens_grid(initial_box_config,sens_params_values,dic_sens,
+                                integrated = False)
+                                
+        elif type_sens_analysis in ['lhs','sobol']:
+            dic_sens = self._run_sens_sampling(initial_box_config,reference,
+                                               integrated = False)
                                     
         return reference, dic_sens
         
@@ -240,9 +601,6 @@ class SensSimulator(SingleSimulator): # For sensitivity analysis
         print('Computing reference')
         reference = super(SensSimulator,self).get_integrated_pol_vars()
         
-        # Get keys of reference (i.e. pol variable names)
-        key_names_ref = list(reference.keys())
-        
         if type_sens_analysis == 'serial':
             # Initialize output
             dic_sens = {}
@@ -251,45 +609,33 @@ class SensSimulator(SingleSimulator): # For sensitivity analysis
                 key_str = '/'.join(key)
                 dic_sens[key_str] = {}
                 print('Sensitivity analysis on param:'+str(key))
-                working_copy = copy.deepcopy(initial_box_config)
                 
                 n_pts = int(param[2])
                 range_var = np.linspace(param[0],param[1],n_pts)
                 current_val = get_from_dict(initial_box_config,key)
                 
-                sens_values = []
                 sens_param_name = key_str
-                if not isinstance(current_val, numbers.Number):
+                if isinstance(current_val, numbers.Number):
+                    sens_values = range_var * current_val
+                else:
                     sens_param_name += ' factor'
+                    sens_values = range_var
+                dic_sens[key_str] = create_sens_arrays(reference,True,(n_pts,),
+                                                       [sens_param_name],[sens_values])
                     
                 for i,r in enumerate(range_var):
-                    if isinstance(current_val, numbers.Number):
-                        sens_values.append(r * current_val)
-                    else:
-                        sens_values.append(r)
-                        
                     print('Step '+str(i+1)+'/'+str(len(range_var)))
-                    # Modify working copy of boxes dict and assign it to current
-                    # simulator
-                    set_from_dict(working_copy ,key,current_val*r)
-                    self.boxes_dic = working_copy
+                    # Assign a view of the boxes with the modified value to
+                    # current simulator
+                    working_copy = ConfigOverlay(initial_box_config,{tuple(key):current_val*r})
+                    self.set_boxes_dic(working_copy,self.sens_params[0])
                                         
                     # Simulate polarimetric variables
                     pol_vars = super(SensSimulator,self).get_integrated_pol_vars()
-                    
                     for k in pol_vars.keys():
-                        if k not in dic_sens[key_str].keys():
-                            dic_sens[key_str][k] = []
-
-                    for k in pol_vars.keys():
-                            dic_sens[key_str][k].append(pol_vars[k])
-                            
-                # Convert lists to InfoArray
-                for k in dic_sens[key_str].keys():
-                    dic_sens[key_str][k] = InfoArray(dic_sens[key_str][k],[sens_param_name],
-                                           [sens_values])
+                        dic_sens[key_str][k][i] = pol_vars[k]
                                            
-        elif type_sens_analysis == 'parallel': # ==> This will be very time-consuming
+        elif type_sens_analysis == 'parallel':
             dic_sens = {}
             # Generate all sequences of values
             dimensions = np.array([p[2] for p in self.sens_params[1]],dtype = int)
@@ -297,41 +643,17 @@ class SensSimulator(SingleSimulator): # For sensitivity analysis
             
         
             sens_params_names = ['/'.join(p) for p in self.sens_params[0]]
-            sens_params_values = [np.linspace(p[0],p[1],p[2]) for p in self.sens_params[1]]  
-            
-            dic_sens = {}
-            
-            
-            for k in key_names_ref:
-                dic_sens[k] = InfoArray(np.zeros(dimensions)+np.nan,
-                              sens_params_names,sens_params_values)
+            sens_params_values = [np.linspace(p[0],p[1],int(p[2])) for p in self.sens_params[1]]  
             
-            # Generate possible combinations of parameter values
-            combinations = list(itertools.product(*sens_params_values))
+            dic_sens = create_sens_arrays(reference,True,dimensions,sens_params_names,
+                                          sens_params_values)
             
-            
-            for i,c in enumerate(combinations):
-                # Get n-D index from 1D index 
-                pos_in_array = np.unravel_index(i,dimensions)
-                
-                working_copy = copy.deepcopy(initial_box_config)
-                print('Step '+str(i+1)+'/'+str(len(combinations)))
-                
-                # Modify working copy of boxes dict and assign it to current
-                # simulator
-                for j,key in enumerate(self.sens_params[0]):
-                    current_val = get_from_dict(initial_box_config,key)
-                    set_from_dict(working_copy,key,current_val*c[j])
-                    
-                self.boxes_dic = working_copy
-                              
-                # Simulate polarimetric variables
-                pol_vars = super(SensSimulator,self).get_integrated_pol_vars()
-
-        
-                for k in pol_vars.keys():
-                    dic_sens[k][pos_in_array]=pol_vars[k]
-
+            self._run_sens_grid(initial_box_config,sens_params_values,dic_sens,
+                                integrated = True)
+                                
+        elif type_sens_analysis in ['lhs','sobol']:
+            dic_sens = self._run_sens_sampling(initial_box_config,reference,
+                                               integrated = True)
         
         return reference, dic_sens
 
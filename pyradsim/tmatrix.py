@@ -7,20 +7,371 @@ Created on Mon May 30 13:36:03 2016
 
 from pytmatrix import orientation
 from pytmatrix.tmatrix import Scatterer
+from pytmatrix.quadrature import quadrature
+import itertools
 import numpy as np
+from scipy.special import erf
+from scipy.integrate import quad
 
 import pyradsim.constants as constants
  
 
-from pyradsim.utilities import Float
+from pyradsim.utilities import PolVars
 
 
-def create_scatterer(wavelength,orientation_std):
+# Units and long names of the polarimetric variables
+POL_VAR_UNITS = {'Zh':'mm^6*m^-3','Zv':'mm^6*m^-3','Zdr':'-','Kdp':'deg*km^-1',
+                 'Delta_hv':'rad','Ah':'dB/km','Av':'dB/km','Rhohv':'-'}
+POL_VAR_NAMES = {'Zh':'Reflectivity factor at horizontal polarization',
+                 'Zv':'Reflectivity factor at vertical polarization',
+                 'Zdr':'Differential reflectivity',
+                 'Kdp':'Specific differential phase shift on propagation',
+                 'Delta_hv':'Phase shift on backscattering',
+                 'Ah':'Specific attenuation at horizontal polarization',
+                 'Av':'Specific attenuation at vertical polarization',
+                 'Rhohv':'Copolar correlation coefficient'}
+
+# Orientation moments, indexed by canting angle std
+_MOMENTS = {}
+# Orientation quadratures, indexed by (canting angle std, tolerance, n_max)
+_QUADRATURES = {}
+# Max. harmonic in alpha and ratio between the harmonics and E[sin(beta)^j]
+# used to choose the orientation quadrature
+N_HARMONICS = 4
+ORIENT_SAFETY = 10.
+# Min. product of the projections of the vertical polarizations on the
+# symmetry axis for the analytic orientation averaging, i.e. elevation
+# angles up to 60 degrees
+ANALYTIC_MIN_PROJECTION = 0.25
+# Max. |m| * size parameter for the analytic orientation averaging, beyond
+# the approximation of S does not hold anymore (resonance of large drops)
+ANALYTIC_MAX_SIZE_PARAMETER = 2.5
+# Canting angle std (in degrees) below which there is no canting: a single
+# orientation (beta = 0) is used, the Gaussian pdf cannot be normalized
+MIN_ORIENTATION_STD = 1E-2
+
+def get_single_orientation():
+    # Orientations (alpha, beta) and weights without canting
+    return (np.zeros(1), np.zeros(1), np.ones(1))
+
+def create_scatterer(wavelength,orientation_std,orientation_averaging = 'fixed',
+                     orientation_quadrature = None):
+    # orientation_averaging is either 'fixed' (quadrature on alpha and beta)
+    # or 'analytic' (closed-form moments, see orient_averaged_analytic)
+    # orientation_quadrature is either None (5 alpha x 10 beta nodes) or 
+    # (tolerance, n_max), see get_orientation_quadrature
     scatt = Scatterer(radius = 1.0, wavelength = wavelength)
-    scatt.or_pdf = orientation.gaussian_pdf(std=orientation_std)
-    scatt.orient = orientation.orient_averaged_fixed
+    scatt.or_std = orientation_std
+    if orientation_std < MIN_ORIENTATION_STD:
+        # No canting, no pdf
+        scatt.or_alpha_p, scatt.or_beta_p, scatt.or_w = get_single_orientation()
+    else:
+        scatt.or_pdf = orientation.gaussian_pdf(std=orientation_std)
+        if orientation_quadrature is not None:
+            (scatt.or_alpha_p, scatt.or_beta_p, 
+             scatt.or_w) = get_orientation_quadrature(orientation_std, *orientation_quadrature)
+        
+    if orientation_averaging == 'analytic':
+        scatt.orient = orient_averaged_analytic
+    elif orientation_averaging == 'fixed':
+        if hasattr(scatt, 'or_w'):
+            scatt.orient = orient_averaged_quadrature
+        else:
+            scatt.orient = orientation.orient_averaged_fixed
+    else:
+        raise ValueError('Invalid orientation averaging: '+str(orientation_averaging))
     return scatt
     
+def get_orientation_quadrature(orientation_std, tolerance = 1E-3, n_max = 32):
+    # Orientations (alpha and beta in degrees) and their weights for a 
+    # Gaussian canting angle pdf, chosen for a given accuracy
+    # Harmonic j in alpha of the phase matrix of a Rayleigh scatterer (j <= 4)
+    # is of the order of E[sin(beta)^j], the number of alpha nodes is the
+    # number of harmonics above the tolerance plus one. The beta nodes are
+    # Gauss nodes for the pdf on its effective support, their number is
+    # increased until the moments E[cos(k beta)], k <= 8 are within tolerance
+    key = (orientation_std, tolerance, n_max)
+    if key in _QUADRATURES:
+        return _QUADRATURES[key]
+        
+    if orientation_std < MIN_ORIENTATION_STD: # No canting
+        quadrature_nodes = get_single_orientation()
+        _QUADRATURES[key] = quadrature_nodes
+        return quadrature_nodes
+        
+    pdf = orientation.gaussian_pdf(std=orientation_std)
+    beta_max = min(180., 10 * orientation_std)
+    def moment(func):
+        return quad(lambda b: func(np.deg2rad(b)) * pdf(b), 0, beta_max)[0]
+        
+    sin_moments = [moment(lambda b: np.sin(b)**j) for j in range(1,N_HARMONICS+1)]
+    if ORIENT_SAFETY * sin_moments[1] < tolerance:
+        # Single orientation
+        quadrature_nodes = (np.zeros(1), np.zeros(1), np.ones(1))
+        _QUADRATURES[key] = quadrature_nodes
+        return quadrature_nodes
+    n_alpha = 1 + max([j + 1 for j in range(N_HARMONICS) 
+                       if ORIENT_SAFETY * sin_moments[j] >= tolerance])
+    
+    cos_moments = np.array([moment(lambda b: np.cos(k * b)) for k in range(1,9)])
+    for n_beta in range(1, n_max + 1):
+        beta, beta_w = quadrature.get_points_and_weights(pdf, 0, beta_max, n_beta)
+        beta_w /= np.sum(beta_w)
+        approx = np.array([np.sum(beta_w * np.cos(k * np.deg2rad(beta))) 
+                           for k in range(1,9)])
+        if np.max(np.abs(approx - cos_moments)) < tolerance:
+            break
+            
+    alpha = np.linspace(0, 360, n_alpha + 1)[:-1]
+    alpha, beta = [x.ravel() for x in np.meshgrid(alpha, beta)]
+    weights = np.repeat(beta_w / n_alpha, n_alpha)
+    quadrature_nodes = (alpha, beta, weights)
+    _QUADRATURES[key] = quadrature_nodes
+    return quadrature_nodes
+    
+def orient_averaged_quadrature(tm):
+    # Same as orientation.orient_averaged_fixed, with the orientations given
+    # by get_orientation_quadrature (see create_scatterer)
+    S = np.zeros((2,2), dtype = complex)
+    Z = np.zeros((4,4))
+    for alpha, beta, w in zip(tm.or_alpha_p, tm.or_beta_p, tm.or_w):
+        (S_ang, Z_ang) = tm.get_SZ_single(alpha = alpha, beta = beta)
+        S += w * S_ang
+        Z += w * Z_ang
+    return S, Z
+    
+def get_orientation_moments(orientation_std):
+    # Second (3,3) and fourth (3,3,3,3) order moments of the unit vector along
+    # the symmetry axis, for a uniform alpha and a Gaussian beta with zero 
+    # mean (same pdf as orientation.gaussian_pdf, in degrees)
+    if orientation_std in _MOMENTS:
+        return _MOMENTS[orientation_std]
+        
+    if orientation_std < MIN_ORIENTATION_STD: # No canting
+        cos_2b = 1.
+        cos_4b = 1.
+    else:
+        # E[cos(n*beta)] = (I(n+1) - I(n-1)) / (2 I(1)) with 
+        # I(k) = int_0^pi exp(-beta^2/(2 std^2)) sin(k beta) dbeta
+        sig = np.deg2rad(orientation_std)
+        def I(k):
+            y = k * sig / np.sqrt(2)
+            return (sig * np.sqrt(np.pi / 2) * np.exp(-y**2) *
+                    (erf(np.pi / (np.sqrt(2) * sig) - 1j * y) + erf(1j * y))).imag
+        cos_2b = (I(3) - I(1)) / (2 * I(1))
+        cos_4b = (I(5) - I(3)) / (2 * I(1))
+        
+    cos2 = (1 + cos_2b) / 2.
+    sin2 = (1 - cos_2b) / 2.
+    cos4 = (3 + 4 * cos_2b + cos_4b) / 8.
+    sin4 = (3 - 4 * cos_2b + cos_4b) / 8.
+    sin2cos2 = (1 - cos_4b) / 8.
+    
+    M2 = np.diag([sin2 / 2., sin2 / 2., cos2])
+    
+    # Moments of order 4 only depend on the number of x, y and z indexes
+    values = {(4,0,0): 3 / 8. * sin4, (0,4,0): 3 / 8. * sin4, (2,2,0): sin4 / 8.,
+              (2,0,2): sin2cos2 / 2., (0,2,2): sin2cos2 / 2., (0,0,4): cos4}
+    M4 = np.zeros((3,3,3,3))
+    for idx in itertools.product(range(3), repeat = 4):
+        counts = tuple([idx.count(i) for i in range(3)])
+        M4[idx] = values.get(counts, 0.)
+        
+    _MOMENTS[orientation_std] = (M2, M4)
+    return M2, M4
+    
+def orient_averaged_analytic(tm):
+    # Orientation averaging with a single orientation, can be used as 
+    # tm.orient. The amplitude matrix at any orientation is approximated as
+    # S = a G + d (P_sca.c) (P_inc.c)^T, where c is the symmetry axis and
+    # P_inc, P_sca the polarization vectors (exact in the Rayleigh regime).
+    # a and d are given by S at the reference orientation (c vertical) and
+    # the averages of S and Z follow from the moments of c. Large particles
+    # are averaged numerically
+    pol_inc = get_polarization_vectors(tm.thet0, tm.phi0)
+    pol_sca = get_polarization_vectors(tm.thet, tm.phi)
+    G = pol_sca.dot(pol_inc.T)
+    axis = np.array([0.,0.,1.])
+    u = pol_sca.dot(axis)
+    v = pol_inc.dot(axis)
+    
+    size_parameter = abs(tm.m) * get_size_parameter(2 * tm.radius, tm.wavelength)
+    if (abs(u[0] * v[0]) < ANALYTIC_MIN_PROJECTION or 
+        size_parameter > ANALYTIC_MAX_SIZE_PARAMETER):
+        # Close to vertical incidence, d cannot be retrieved from the 
+        # reference orientation, for large particles the approximation of S
+        # is not valid
+        if hasattr(tm, 'or_w'):
+            return orient_averaged_quadrature(tm)
+        if not hasattr(tm, 'beta_p'):
+            tm.beta_p, tm.beta_w = quadrature.get_points_and_weights(tm.or_pdf, 0,
+                                                                     180, tm.n_beta)
+        return orientation.orient_averaged_fixed(tm)
+    
+    S_ref = tm.get_SZ_single(alpha = 0., beta = 0.)[0]
+    # The horizontal polarization is perpendicular to the axis
+    a = S_ref[1,1] / G[1,1]
+    d = (S_ref[0,0] - a * G[0,0]) / (u[0] * v[0])
+    
+    M2, M4 = get_orientation_moments(tm.or_std)
+    W = pol_sca.dot(M2).dot(pol_inc.T)
+    Q = np.einsum('ijkl,pi,qj,rk,sl->pqrs', M4, pol_sca, pol_inc, pol_sca, pol_inc)
+    
+    S = a * G + d * W
+    # Averages of the products S_pq S_rs^*
+    SS = (abs(a)**2 * np.multiply.outer(G, G) + a * np.conj(d) * np.multiply.outer(G, W) +
+          d * np.conj(a) * np.multiply.outer(W, G) + abs(d)**2 * Q)
+    Z = get_phase_matrix_from_products(SS.reshape(4,4))
+    return S, Z
+
+def get_geometries(theta):
+    # Backward and forward geometries for a given elevation angle (in degrees)
+    # For a vector of elevation angles, returns a list of (back, forw)
+    if np.ndim(theta) > 0:
+        return [get_geometries(t) for t in theta]
+    geom_back = (90-theta, 180-(90-theta), 0., 180, 0.0,0.0) # Backward
+    geom_forw = (90-theta, 90-theta, 0., 0.0, 0.0,0.0) # Forward
+    return geom_back, geom_forw
+
+def compute_SZ(scatt, geometries, D, m, ar):
+    # Forward amplitude matrix and backward phase matrix of a single particle
+    # If geometries is a list of (back, forw), returns arrays S (n_geom,2,2)
+    # and Z (n_geom,4,4), the T-matrix is computed only once
+    if isinstance(geometries, list):
+        all_SZ = [compute_SZ(scatt, g, D, m, ar) for g in geometries]
+        return (np.array([SZ[0] for SZ in all_SZ]), np.array([SZ[1] for SZ in all_SZ]))
+        
+    scatt.m = m
+    scatt.axis_ratio = ar
+    scatt.radius = D/2.0
+    
+    scatt.set_geometry(geometries[0])
+    (S_back, Z_back) = scatt.get_SZ_orient()
+    
+    scatt.set_geometry(geometries[1])
+    (S_forw, Z_forw) = scatt.get_SZ_orient()
+    
+    return (S_forw,Z_back)
+    
+def get_size_parameter(D, wavelength):
+    return np.pi * D / wavelength
+    
+def get_depolarization_factors(ar):
+    # Depolarization factors of spheroids along the horizontal axes (L_a) 
+    # and the symmetry axis (L_c), ar = horizontal / vertical axis
+    ar = np.asarray(ar, dtype = float)
+    L_c = np.zeros(ar.shape) + 1/3.
+    
+    oblate = ar > 1 + 1E-6
+    f = np.sqrt(ar[oblate]**2 - 1)
+    L_c[oblate] = (1 + f**2) / f**2 * (1 - np.arctan(f) / f)
+    
+    prolate = ar < 1 - 1E-6
+    e = np.sqrt(1 - ar[prolate]**2)
+    L_c[prolate] = (1 - e**2) / e**2 * (np.log((1 + e) / (1 - e)) / (2 * e) - 1)
+    
+    L_a = (1 - L_c) / 2.
+    return L_a, L_c
+    
+def get_polarization_vectors(thet, phi):
+    # Unit vectors along theta (vertical pol.) and phi (horizontal pol.) for
+    # a direction of propagation given in degrees, returns array (2,3)
+    thet = np.deg2rad(thet)
+    phi = np.deg2rad(phi)
+    return np.array([[np.cos(thet)*np.cos(phi), np.cos(thet)*np.sin(phi), -np.sin(thet)],
+                     [-np.sin(phi), np.cos(phi), 0.]])
+                     
+def get_phase_matrix(S):
+    # Phase matrix Z (...,4,4) from amplitude matrix S (...,2,2)
+    S = S.reshape(S.shape[:-2] + (4,))
+    return get_phase_matrix_from_products(S[...,:,None] * np.conj(S[...,None,:]))
+    
+def get_phase_matrix_from_products(SS):
+    # Phase matrix Z (...,4,4) from the products SS (...,4,4) of the elements
+    # of the amplitude matrix, SS[i,j] = S_i S_j^* with the elements ordered
+    # as S11, S12, S21, S22, see Mishchenko et al. (2002), Scattering, 
+    # absorption and emission of light by small particles, eq. 2.106-2.121
+    P = lambda i,j : SS[...,i,j]
+    
+    Z = np.zeros(SS.shape[:-2] + (4,4))
+    Z[...,0,0] = 0.5 * (P(0,0) + P(1,1) + P(2,2) + P(3,3)).real
+    Z[...,0,1] = 0.5 * (P(0,0) - P(1,1) + P(2,2) - P(3,3)).real
+    Z[...,0,2] = -(P(0,1) + P(3,2)).real
+    Z[...,0,3] = -(P(0,1) - P(3,2)).imag
+    Z[...,1,0] = 0.5 * (P(0,0) + P(1,1) - P(2,2) - P(3,3)).real
+    Z[...,1,1] = 0.5 * (P(0,0) - P(1,1) - P(2,2) + P(3,3)).real
+    Z[...,1,2] = -(P(0,1) - P(3,2)).real
+    Z[...,1,3] = -(P(0,1) + P(3,2)).imag
+    Z[...,2,0] = -(P(0,2) + P(3,1)).real
+    Z[...,2,1] = -(P(0,2) - P(3,1)).real
+    Z[...,2,2] = (P(0,3) + P(1,2)).real
+    Z[...,2,3] = (P(0,3) + P(2,1)).imag
+    Z[...,3,0] = (P(2,0) + P(3,1)).imag
+    Z[...,3,1] = (P(2,0) - P(3,1)).imag
+    Z[...,3,2] = (P(3,0) - P(1,2)).imag
+    Z[...,3,3] = (P(3,0) - P(1,2)).real
+    return Z
+    
+def compute_SZ_rayleigh(wavelength, orientation_std, geometries, list_D, all_m, all_ar,
+                        orientation_quadrature = None):
+    # Forward amplitude matrices and backward phase matrices of small
+    # spheroids in the Rayleigh regime, vectorized over all diameters, with
+    # the same orientation averaging as create_scatterer
+    # Returns arrays S (n,4) and Z (n,16), or S (n,n_geom,4) and 
+    # Z (n,n_geom,16) if geometries is a list of (back, forw)
+    if isinstance(geometries, list):
+        all_SZ = [compute_SZ_rayleigh(wavelength, orientation_std, g, list_D, all_m,
+                                      all_ar, orientation_quadrature) for g in geometries]
+        return (np.stack([SZ[0] for SZ in all_SZ], axis = 1),
+                np.stack([SZ[1] for SZ in all_SZ], axis = 1))
+                
+    list_D = np.asarray(list_D, dtype = float)
+    k = 2 * np.pi / wavelength
+    
+    # Polarizabilities along horizontal axes and symmetry axis (in mm^3)
+    eps = np.asarray(all_m)**2
+    L_a, L_c = get_depolarization_factors(all_ar)
+    vol = (list_D / 2.)**3 / 3.
+    pol_a = vol * (eps - 1) / (1 + L_a * (eps - 1))
+    pol_c = vol * (eps - 1) / (1 + L_c * (eps - 1))
+    
+    # Orientations of the symmetry axis and their weights
+    if orientation_std < MIN_ORIENTATION_STD: # No canting
+        alpha, beta, weights = get_single_orientation()
+    elif orientation_quadrature is None:
+        scatt = create_scatterer(wavelength, orientation_std)
+        alpha = np.linspace(0, 360, scatt.n_alpha + 1)[:-1]
+        beta, beta_w = quadrature.get_points_and_weights(scatt.or_pdf, 0, 180, scatt.n_beta)
+        alpha, beta = [x.ravel() for x in np.meshgrid(alpha, beta)]
+        weights = np.repeat(beta_w / (scatt.n_alpha * np.sum(beta_w)), scatt.n_alpha)
+    else:
+        alpha, beta, weights = get_orientation_quadrature(orientation_std,
+                                                          *orientation_quadrature)
+    alpha = np.deg2rad(alpha)
+    beta = np.deg2rad(beta)
+    axis = np.column_stack((np.sin(beta)*np.cos(alpha), np.sin(beta)*np.sin(alpha),
+                            np.cos(beta)))
+    
+    out = []
+    for geom in geometries:
+        # S_pq = k^2 p_sca . A . q_inc with A = pol_a I + (pol_c - pol_a) a a^T
+        pol_inc = get_polarization_vectors(geom[0], geom[2])
+        pol_sca = get_polarization_vectors(geom[1], geom[3])
+        G = pol_sca.dot(pol_inc.T)
+        u = axis.dot(pol_sca.T) # (n_orient, 2)
+        v = axis.dot(pol_inc.T)
+        uv = u[:,:,None] * v[:,None,:] # (n_orient, 2, 2)
+        S = k**2 * (pol_a[:,None,None,None] * G[None,None] + 
+                    (pol_c - pol_a)[:,None,None,None] * uv[None])
+        # Average over orientations
+        Z = np.einsum('o,nokl->nkl', weights, get_phase_matrix(S))
+        S = np.einsum('o,nokl->nkl', weights, S)
+        out.append((S, Z))
+        
+    S_forw = out[1][0].reshape(-1, 4).astype('c8')
+    Z_back = out[0][1].reshape(-1, 16).astype('float32')
+    return S_forw, Z_back
+    
 def flatten_matrices(list_matrices):
     arr_S=np.zeros((len(list_matrices),4),dtype='c8')
     arr_Z=np.zeros((len(list_matrices),16),dtype='float32')
@@ -37,25 +388,16 @@ def flatten_matrices(list_matrices):
        
        
 def compute_pol_var(S,Z,F):
-    # Transform SZ to two S matrices and one Z matrices
+    # Polarimetric variables from the amplitude (...,4) and phase (...,16)
+    # matrices, with any number of leading dimensions, F must be
+    # broadcastable to these dimensions
     wavelength=constants.C/(F*1E09)*1000 # in mm
     siz = S.shape
     
-    if len(siz) == 1:
-        Z = Z.reshape(4,4)
-        S = S.reshape(2,2)
-    elif len(siz) == 2:
-        Z = Z.reshape(siz[0],4,4)
-        Z = np.swapaxes(Z,0,2)
-        S = S.reshape(siz[0],2,2)
-        S = np.swapaxes(S,0,2)
-    elif len(siz) == 3:
-        Z = Z.reshape(siz[0],siz[1],4,4)
-        Z = np.swapaxes(Z,0,2)
-        Z = np.swapaxes(Z,1,3)
-        S = S.reshape(siz[0],siz[1],2,2)       
-        S = np.swapaxes(S,0,2)
-        S = np.swapaxes(S,1,3)
+    # The elements of the matrices are put in the first two dimensions,
+    # S[i,j] and Z[i,j] have the shape of the leading dimensions of the inputs
+    Z = np.moveaxis(Z.reshape(siz[:-1] + (4,4)), [-2,-1], [0,1])
+    S = np.moveaxis(S.reshape(siz[:-1] + (2,2)), [-2,-1], [0,1])
         
     # Horizontal reflectivity
     radar_xsect_h=2*np.pi*(Z[0,0] - Z[0,1] - Z[1,0] + Z[1,1])
@@ -87,46 +429,36 @@ def compute_pol_var(S,Z,F):
     rhohv = np.sqrt(a / (b*c))
     
     
-    # Create output dictionary
-    
-    out = {}    
-    
-    zh = Float(zh)
-    zh.units = 'mm^6*m^-3'
-    out['Zh'] = zh
-    ##
-    zv = Float(zv)
-    zv.units = 'mm^6*m^-3'
-    out['Zv'] = zv  
-    ##
-    zdr = Float(zdr)
-    zdr.units = '-'
-    zdr.name = 'Specific attenuation at horizontal pol'
-    out['Zdr'] = zdr      
-    ##
-    kdp = Float(kdp)
-    kdp.units = 'deg*km^-1'
-    kdp.name = 'Specific differential phase shift on propagation'
-    out['Kdp'] = kdp
-    ##
-    delta_hv = Float(delta_hv)
-    delta_hv.units = 'deg*km^-1'
-    delta_hv.name = 'Phase shift on backscattering'
-    out['Delta_hv'] = kdp
-    ##
-    ah = Float(ah)
-    ah.units = 'dB/km'
-    ah.name = 'Specific attenuation at horizontal polarization'
-    out['Ah'] = ah
-    ##
-    av = Float(av)
-    av.units = 'dB/km'
-    av.name = 'Specific attenuation at vertical polarization'
-    out['Av'] = av    
-    ##
-    rhohv = Float(rhohv)
-    rhohv.units = '-'
-    rhohv.name = 'Copolar correlation coefficient'
-    out['Rhohv'] = rhohv       
+    # Create output container, all variables are float64 arrays
+    out = PolVars(POL_VAR_UNITS, POL_VAR_NAMES)
+    for k, v in [('Zh',zh),('Zv',zv),('Zdr',zdr),('Kdp',kdp),('Delta_hv',delta_hv),
+                 ('Ah',ah),('Av',av),('Rhohv',rhohv)]:
+        out[k] = np.asarray(v, dtype = np.float64)
     return out
     
+    
+if __name__ == '__main__':
+    # Without canting (std = 0), all orientation averagings must give the
+    # scattering of the particle with its symmetry axis vertical
+    wavelength = constants.C/(5.6*1E09)*1000 # in mm
+    geometries = get_geometries(10)
+    D, m, ar = 2., complex(8.6,1.8), 1.2
+    scatt = create_scatterer(wavelength, 0.)
+    scatt.orient = orientation.orient_single
+    S_ref, Z_ref = compute_SZ(scatt, geometries, D, m, ar)
+    for averaging, quadrature_settings in [('fixed',None),('fixed',(1E-3,32)),
+                                           ('analytic',None)]:
+        scatt = create_scatterer(wavelength, 0., averaging, quadrature_settings)
+        S, Z = compute_SZ(scatt, geometries, D, m, ar)
+        assert np.allclose(S, S_ref) and np.allclose(Z, Z_ref)
+    # Rayleigh regime
+    D = 0.2
+    scatt = create_scatterer(wavelength, 0.)
+    scatt.orient = orientation.orient_single
+    S_ref, Z_ref = compute_SZ(scatt, geometries, D, m, ar)
+    for quadrature_settings in [None,(1E-3,32)]:
+        S, Z = compute_SZ_rayleigh(wavelength, 0., geometries, [D], [m], [ar],
+                                   quadrature_settings)
+        assert np.allclose(S[0], S_ref.ravel(), rtol = 1E-2, atol = 1E-2 * np.abs(S_ref).max())
+        assert np.allclose(Z[0], Z_ref.ravel(), rtol = 1E-2, atol = 1E-2 * np.abs(Z_ref).max())
+    print('No canting: OK')
@@ -8,6 +8,7 @@ Created on Thu May 26 16:21:20 2016
 import re
 import functools
 import collections
+import collections.abc
 import numpy as np
 
 class Float(float):
@@ -15,21 +16,34 @@ class Float(float):
         return float.__new__(cls, arg)
         
 class Lambda(object):
-    def __init__(self,lambda_f, expression):
+    # Scaling and offsets (e.g. from the sensitivity analysis) are folded in
+    # scale and offset instead of wrapping the function in a new lambda
+    def __init__(self,lambda_f, expression, scale = 1, offset = 0):
         self.expression = expression
         self.lambda_f = lambda_f
+        self.scale = scale
+        self.offset = offset
     def __call__(self,*inputs):
-        return self.lambda_f(*inputs)
+        out = self.lambda_f(*inputs)
+        if self.scale != 1:
+            out = out * self.scale
+        if self.offset != 0:
+            out = out + self.offset
+        return out
     def __str__(self):
         return self.expression
     def __mul__(self,scalar):
-        return Lambda(lambda *args: self.__call__(*args)*scalar,str(scalar)+'*'+self.expression)
+        return Lambda(self.lambda_f,str(scalar)+'*'+self.expression,
+                      self.scale*scalar,self.offset*scalar)
     def __rdiv__(self,scalar):
-        return Lambda(lambda *args: self.__call__(*args)/scalar,str(scalar)+'/'+self.expression)        
+        return Lambda(self.lambda_f,str(scalar)+'/'+self.expression,
+                      self.scale/scalar,self.offset/scalar)
     def __add__(self,scalar):
-        return Lambda(lambda *args: self.__call__(*args)+scalar,str(scalar)+'+'+self.expression) 
+        return Lambda(self.lambda_f,str(scalar)+'+'+self.expression,
+                      self.scale,self.offset+scalar)
     def __sub__(self,scalar):
-        return Lambda(lambda *args: self.__call__(*args)-scalar,str(scalar)+'-'+self.expression)         
+        return Lambda(self.lambda_f,str(scalar)+'-'+self.expression,
+                      self.scale,self.offset-scalar)
     
 class InfoArray(np.ndarray):
     def __new__(cls, input_array,attr_names,attr_data):
@@ -65,11 +79,60 @@ class InfoArray(np.ndarray):
             strr += attr + ' : ' + str(self.attributes[attr]) +'\n'
         return strr
         
+class PolVars(collections.OrderedDict):
+    # Columnar container of polarimetric variables, one float64 array per
+    # variable (with the leading dimensions of the scattering matrices), the
+    # units and long names are stored once per variable and the coordinates
+    # of the dimensions (e.g. frequency, elevation_angle) once for all
+    def __init__(self, units = None, names = None):
+        super(PolVars,self).__init__()
+        self.units = units if units is not None else {}
+        self.names = names if names is not None else {}
+        self.attributes = collections.OrderedDict()
+        
+    def __str__(self):
+        strr = ''
+        for k in self.keys():
+            strr += k + ' [' + self.units.get(k,'') + '] : ' + str(self[k]) + '\n'
+        if len(self.attributes):
+            strr += 'Attributes: \n'
+            for attr in self.attributes.keys():
+                strr += attr + ' : ' + str(self.attributes[attr]) + '\n'
+        return strr
+        
+class ConfigOverlay(collections.abc.Mapping):
+    # Read-only view of a nested dictionary (base) in which the values at
+    # some key paths are replaced, overrides are indexed by tuples of keys.
+    # Nothing is copied, nested dictionaries with overrides are views too,
+    # the base must not be modified while views are in use
+    def __init__(self, base, overrides = None, path = ()):
+        self._base = base
+        self._overrides = overrides if overrides is not None else {}
+        self._path = path
+        
+    def __getitem__(self, key):
+        path = self._path + (key,)
+        if path in self._overrides:
+            return self._overrides[path]
+        value = self._base[key]
+        if isinstance(value, collections.abc.Mapping):
+            n = len(path)
+            if any([p[:n] == path for p in self._overrides.keys()]):
+                return ConfigOverlay(value, self._overrides, path)
+        return value
+        
+    def __iter__(self):
+        return iter(self._base)
+        
+    def __len__(self):
+        return len(self._base)
+        
 def create_defaults():
     content = '''
 hydrometeors:
     permittivity: 8.5871375786139676+1.6977965395728176j
     canting_angle_std: 10
+    orientation_averaging: fixed # or analytic
     psd: [COSMO_1mom_rain,0.0001] # Marshall-Palmer with R = 2 mm/hr
     psd_range: [0.1,20]
     aspect_ratio: 0.9
@@ -124,7 +187,7 @@ def flatten(d, parent_key='', sep='/'):
     items = []
     for k, v in d.items():
         new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, collections.MutableMapping):
+        if isinstance(v, collections.abc.MutableMapping):
             items.extend(flatten(v, new_key, sep=sep).items())
         else:
             items.append((new_key, v))
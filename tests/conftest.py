@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Jul 11 09:14:02 2016
+
+@author: wolfensb
+"""
+
+import os
+import sys
+import pytest
+
+# The modules are imported both as pyradsim.module and as module (e.g. tictoc)
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT,'pyradsim')]
+
+@pytest.fixture
+def executor():
+    # T-matrix computations in the current process
+    from pyradsim.executor import ScatteringExecutor
+    executor = ScatteringExecutor(processes = 1)
+    yield executor
+    executor.close()
+    
+@pytest.fixture
+def make_hydrometeor(executor):
+    # Builds a rain hydrometeor from the same inputs as a box file, the 
+    # keyword arguments are given to the Hydrometeor
+    from pyradsim.hydrometeor import Hydrometeor
+    from pyradsim.parse import parse_psd, parse_aspect_ratio, parse_permittivity
+    
+    def get_specs(psd = ['ExponentialPSD',8000,2.0,0.1,8], aspect_ratio = 0.7,
+                  canting_angle_std = 0, permittivity = 'water', **specs):
+        specs['psd'] = parse_psd(psd)
+        specs['aspect_ratio'] = parse_aspect_ratio(aspect_ratio)
+        specs['canting_angle_std'] = canting_angle_std
+        specs['permittivity'] = parse_permittivity(permittivity)
+        return specs
+        
+    def make(specs = None, frequency = 5.6, temperature = 283, elevation_angle = 0,
+             nbins_d = 64, **kwargs):
+        kwargs.setdefault('executor', executor)
+        return Hydrometeor('rain', get_specs(**(specs or {})), frequency, temperature,
+                           elevation_angle, nbins_d, **kwargs)
+        
+    make.get_specs = get_specs
+    return make
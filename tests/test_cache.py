@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Jul 13 11:02:55 2016
+
+@author: wolfensb
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pytmatrix')
+
+from pyradsim.cache import ScatteringCache
+from pyradsim.lut import ScatteringLUT, LUT_AXES
+
+def get_lut(frequency = 5.6):
+    # Table that does not cover the diameters of the PSDs of the tests, it
+    # is selected but never interpolated
+    axes = dict((ax,[0.]) for ax in LUT_AXES)
+    axes['D'] = [0.01,0.02]
+    shape = tuple([len(axes[ax]) for ax in LUT_AXES])
+    return ScatteringLUT(frequency, axes, np.zeros(shape + (4,), dtype = complex),
+                         np.zeros(shape + (16,)))
+                         
+def test_cache_hit_miss(make_hydrometeor, tmp_path):
+    cache = ScatteringCache(str(tmp_path))
+    S, Z = make_hydrometeor(cache = cache).get_SZ()
+    assert (cache.hits, cache.misses) == (0, 1)
+    
+    # Same scattering in another hydrometeor (e.g. in another run)
+    S_cached, Z_cached = make_hydrometeor(cache = cache).get_SZ()
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert np.array_equal(S, S_cached) and np.array_equal(Z, Z_cached)
+    
+    # Other aspect ratio, other Rayleigh threshold or with a lookup table
+    make_hydrometeor(cache = cache, specs = {'aspect_ratio':0.9}).get_SZ()
+    make_hydrometeor(cache = cache, rayleigh_threshold = 0).get_SZ()
+    make_hydrometeor(cache = cache, luts = [get_lut()]).get_SZ()
+    assert (cache.hits, cache.misses) == (1, 4)
+    make_hydrometeor(cache = cache, luts = [get_lut()]).get_SZ()
+    assert (cache.hits, cache.misses) == (2, 4)
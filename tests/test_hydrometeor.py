@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Jul 11 09:31:47 2016
+
+@author: wolfensb
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pytmatrix')
+
+GAUSS = {'method':'gauss','tolerance':1E-4}
+
+def test_grid_after_gauss(make_hydrometeor):
+    # The quadrature nodes must not mark the master grid as computed
+    h = make_hydrometeor(integration = GAUSS)
+    h.get_SZ_integrated()
+    S, Z = h.get_SZ()
+    assert h.list_D is not None and len(h.list_D) == len(S)
+    
+    integ_S, integ_Z = h.get_SZ_integrated_batch([h.psd])
+    ref_S, ref_Z = make_hydrometeor().get_SZ_integrated()
+    assert np.allclose(integ_S[0], ref_S) and np.allclose(integ_Z[0], ref_Z)
+    
+def test_switch_integration_method(make_hydrometeor):
+    # trapz, then gauss with another aspect ratio, then trapz again: the
+    # master grid must be recomputed with the new aspect ratio
+    h = make_hydrometeor()
+    h.get_SZ_integrated()
+    specs = make_hydrometeor.get_specs(aspect_ratio = 0.9)
+    h.update(specs, 5.6, 283, 0, 64, integration = GAUSS)
+    h.get_SZ_integrated()
+    h.update(specs, 5.6, 283, 0, 64)
+    integ_S, integ_Z = h.get_SZ_integrated()
+    
+    ref_S, ref_Z = make_hydrometeor(specs = {'aspect_ratio':0.9}).get_SZ_integrated()
+    assert np.allclose(integ_S, ref_S) and np.allclose(integ_Z, ref_Z)
+    
+def test_gauss_vs_trapz(make_hydrometeor):
+    # The adaptive quadrature must agree with a fine trapezoidal integration
+    gauss = make_hydrometeor(integration = GAUSS).get_pol_vars()
+    trapz = make_hydrometeor(nbins_d = 1024).get_pol_vars()
+    for k in ['Zh','Zdr','Kdp']:
+        assert abs(gauss[k] - trapz[k]) < 1E-3 * abs(trapz[k])
+        
+def test_batch_vs_single(make_hydrometeor):
+    # PSDs with different ranges integrated in one batch give the same 
+    # results as every PSD alone on the same master grid
+    h = make_hydrometeor()
+    all_psds = [['ExponentialPSD',8000,2.0,0.1,8],['ExponentialPSD',4000,1.5,0.3,6],
+                ['NormalizedGammaPSD',1000,1.2,4,0.1,8]]
+    all_psds = [make_hydrometeor(specs = {'psd':psd}).psd for psd in all_psds]
+    integ_S, integ_Z = h.get_SZ_integrated_batch(all_psds)
+    for i,psd in enumerate(all_psds):
+        h.psd = psd
+        S, Z = h.get_SZ_integrated()
+        assert np.allclose(integ_S[i], S) and np.allclose(integ_Z[i], Z)
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Jul 13 14:48:10 2016
+
+@author: wolfensb
+"""
+
+import numpy as np
+import pytest
+
+from pyradsim.permittivity_models import permittivity_mixture, permittivity_water
+from pyradsim.permittivity_models import permittivity_ice, PermittivityModel
+
+@pytest.mark.parametrize('rule', ['bohren_battan','maxwell_garnett'])
+def test_vectorized_mixing(rule):
+    # Mixing all diameters at once must give the same results as mixing
+    # them one by one
+    T = np.linspace(250., 273., 5)
+    fracs = np.array([np.linspace(0.1, 0.6, 5), np.linspace(0.3, 0.1, 5)])
+    fracs = np.vstack((fracs, 1 - np.sum(fracs, axis = 0)))
+    m = np.array([permittivity_ice(T, 9.41), permittivity_water(T, 9.41), 
+                  np.ones(5, dtype = complex)])
+    m_mix = permittivity_mixture(fracs, m, rule)
+    for i in range(len(T)):
+        assert np.allclose(m_mix[i], permittivity_mixture(fracs[:,i], m[:,i], rule))
+        
+def test_table_settings():
+    # Models with and without table are independent
+    exact = PermittivityModel('water')
+    table = PermittivityModel('water', (0.5, 0.1, 'nearest'))
+    assert exact.get_source() == 'exact' and table.get_source() != exact.get_source()
+    assert exact(283.2, 5.63, 1.) == permittivity_water(283.2, 5.63)
+    assert np.isclose(table(283.2, 5.63, 1.), permittivity_water(283., 5.6))
+    assert table.get_temperature(283.2) == 283.
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Jul 13 14:21:36 2016
+
+@author: wolfensb
+"""
+
+import numpy as np
+import pytest
+
+from pyradsim.psd import PSD, ExponentialPSD, NormalizedGammaPSD, UnnormalizedGammaPSD
+
+@pytest.mark.parametrize('psd', [ExponentialPSD(8000,2.0,0.1,8), 
+                                 NormalizedGammaPSD(1000,1.2,4,0.1,8),
+                                 UnnormalizedGammaPSD(5000,3.5,2,0.2,6)])
+def test_analytic_moments(psd):
+    # Truncated analytic moments against the numerical integration
+    for order in range(7):
+        numeric = PSD.moment(psd, order, 20000)
+        assert abs(psd.moment(order) - numeric) < 1E-5 * numeric
+        
+def test_modified_psd_moments():
+    # Operators on a PSD fall back to the numerical integration
+    psd = ExponentialPSD(8000,2.0,0.1,8)
+    assert abs((psd * 2).moment(3, 20000) - 2 * psd.moment(3)) < 1E-5 * psd.moment(3)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Jul 13 15:40:09 2016
+
+@author: wolfensb
+"""
+
+import numpy as np
+
+from pyradsim.sampling import latin_hypercube, saltelli_design
+from pyradsim.sampling import get_saltelli_indices, get_binned_indices
+
+BOUNDS = np.array([[0.,1.],[0.,1.],[0.,1.]])
+# Linear models y = x.a with uniform inputs: S1_i = ST_i = a_i^2 / sum(a^2)
+COEFS = np.array([[1.,2.,0.],[3.,0.,1.]]).T
+
+def test_indices_along_first_axis():
+    # Outputs with an extra dimension (e.g. frequency), the indices of every
+    # column are the ones of the column alone
+    samples = saltelli_design(4096, BOUNDS, seed = 0)
+    y = samples.dot(COEFS)
+    S1, ST = get_saltelli_indices(y, 3)
+    assert S1.shape == (3, 2) and ST.shape == (3, 2)
+    expected = COEFS**2 / np.sum(COEFS**2, axis = 0)
+    assert np.allclose(S1, expected, atol = 0.05)
+    assert np.allclose(ST, expected, atol = 0.05)
+    for j in range(2):
+        S1_j, ST_j = get_saltelli_indices(y[:,j], 3)
+        assert np.allclose(S1[:,j], S1_j) and np.allclose(ST[:,j], ST_j)
+        
+    samples = latin_hypercube(1024, BOUNDS, seed = 0)
+    y = samples.dot(COEFS)
+    S1, ST = get_binned_indices(samples, y)
+    assert S1.shape == (3, 2) and np.all(np.isnan(ST))
+    # The binned estimates are biased upwards by about 1 / nb of bins
+    assert np.allclose(S1, expected, atol = 0.1)
+    
+def test_constant_outputs():
+    samples = latin_hypercube(64, BOUNDS, seed = 0)
+    S1, ST = get_binned_indices(samples, np.ones((64, 2)))
+    assert np.all(np.isnan(S1)) and np.all(np.isnan(ST))
+    
+def test_ishigami():
+    # Ishigami function (a = 7, b = 0.1) on [-pi, pi]^3, analytic indices
+    bounds = np.array([[-np.pi,np.pi]] * 3)
+    ishigami = lambda x: (np.sin(x[:,0]) + 7 * np.sin(x[:,1])**2 + 
+                          0.1 * x[:,2]**4 * np.sin(x[:,0]))
+    samples = saltelli_design(8192, bounds, seed = 0)
+    S1, ST = get_saltelli_indices(ishigami(samples), 3)
+    assert np.allclose(S1, [0.3139, 0.4424, 0.], atol = 0.03)
+    assert np.allclose(ST, [0.5576, 0.4424, 0.2437], atol = 0.03)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jul 12 10:22:18 2016
+
+@author: wolfensb
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pytmatrix')
+
+import pyradsim.constants as constants
+from pyradsim.tmatrix import create_scatterer, compute_SZ, compute_pol_var, get_geometries
+from pyradsim.tmatrix import compute_SZ_rayleigh
+from pyradsim.permittivity_models import permittivity_water
+
+def get_drop_ar(D):
+    # Aspect ratio (horizontal / vertical) of raindrops (Thurai et al., 2007)
+    return 1. / (1.0048 + 5.7E-4 * D - 2.628E-2 * D**2 + 3.682E-3 * D**3 - 1.677E-4 * D**4)
+    
+def get_pol_vars(orientation_averaging, frequency, elevation_angle, D, std = 20.):
+    wavelength = constants.C / (frequency * 1E09) * 1000 # in mm
+    scatt = create_scatterer(wavelength, std, orientation_averaging)
+    m = complex(permittivity_water(283., frequency))
+    S, Z = compute_SZ(scatt, get_geometries(elevation_angle), D, m, get_drop_ar(D))
+    return compute_pol_var(S.ravel(), Z.ravel(), frequency)
+    
+@pytest.mark.parametrize('frequency', [5.6, 35.6])
+@pytest.mark.parametrize('elevation_angle', [0, 30])
+@pytest.mark.parametrize('D', [2., 5., 7.])
+def test_analytic_averaging(frequency, elevation_angle, D):
+    # Canted drops, the analytic averaging must stay close to the quadrature
+    # also for large drops at high frequencies
+    ref = get_pol_vars('fixed', frequency, elevation_angle, D)
+    pol = get_pol_vars('analytic', frequency, elevation_angle, D)
+    assert abs(10 * np.log10(pol['Zh'] / ref['Zh'])) < 0.05
+    assert abs(10 * np.log10(pol['Zdr'] / ref['Zdr'])) < 0.02
+    assert abs(pol['Kdp'] - ref['Kdp']) < 0.01 * abs(ref['Kdp'])
+    
+@pytest.mark.parametrize('std', [0., 10.])
+def test_rayleigh_below_threshold(std):
+    # Below the threshold the Rayleigh approximation replaces the T-matrix
+    # method, both must agree within a few hundredths of dB
+    frequency = 5.6
+    wavelength = constants.C / (frequency * 1E09) * 1000 # in mm
+    m = complex(permittivity_water(283., frequency))
+    geometries = get_geometries(10.)
+    D_max = constants.RAYLEIGH_THRESHOLD * wavelength / (np.pi * abs(m))
+    for D in [0.5 * D_max, D_max]:
+        S, Z = compute_SZ_rayleigh(wavelength, std, geometries, [D], [m], [get_drop_ar(D)])
+        pol = compute_pol_var(S[0], Z[0], frequency)
+        scatt = create_scatterer(wavelength, std)
+        S, Z = compute_SZ(scatt, geometries, D, m, get_drop_ar(D))
+        ref = compute_pol_var(S.ravel(), Z.ravel(), frequency)
+        assert abs(10 * np.log10(pol['Zh'] / ref['Zh'])) < 0.04
+        assert abs(10 * np.log10(pol['Zdr'] / ref['Zdr'])) < 0.04